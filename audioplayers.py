@@ -1,13 +1,18 @@
 from flask_babel import _
+from time import sleep, monotonic
 import subprocess
+import threading
 import os
 import socket
 import struct
 import logging
+import re
 
 # Optional modules/packages
 try:
     import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 except ImportError:
     pass
 
@@ -51,7 +56,19 @@ __all__ = [
 ]
 
 
+class QueueError(Exception):
+    """Raised by ``AudioPlayer.queue_many`` when some of the files may have been queued. ``failed`` holds the indexes of
+    the files that certainly haven't been, which are the only ones that can be sent again."""
+    def __init__(self, message, failed):
+        super(QueueError, self).__init__(message)
+
+        self.failed = failed
+
+
 class AudioPlayer:
+    _executable_paths = {} # Process name => (PID, creation time, executable path)
+    _executable_paths_lock = threading.Lock()
+
     def __init__(self, config={}):
         self.config = config
 
@@ -62,20 +79,52 @@ class AudioPlayer:
             subprocess.run(args, check=True)
 
     def _get_executable_path(self, proc_name):
-        path = None
+        """Return the executable path of the running process which name contains ``proc_name``.
 
-        for proc in psutil.process_iter():
-            try:
-                if proc_name in proc.name():
+        The path is cached along the process it was found in, so processes are only scanned again once it has exited.
+        """
+        with AudioPlayer._executable_paths_lock:
+            cached = AudioPlayer._executable_paths.get(proc_name)
+
+            if cached:
+                pid, create_time, path = cached
+
+                try:
+                    # The creation time makes sure the PID hasn't been reused by another process
+                    if psutil.Process(pid).create_time() == create_time:
+                        return path
+                except psutil.Error:
+                    pass
+
+                del AudioPlayer._executable_paths[proc_name]
+
+            access_denied = False
+
+            # The executable path is only read from the matching process, as it is expensive to get
+            for proc in psutil.process_iter(attrs=['name', 'create_time']):
+                info = proc.info
+
+                if not info['name'] or proc_name not in info['name']:
+                    continue
+
+                try:
                     path = proc.exe()
-                    break
-            except psutil.NoSuchProcess:
-                pass
+                except psutil.AccessDenied:
+                    access_denied = True
+
+                    continue
+                except psutil.NoSuchProcess:
+                    continue
 
-        if not path:
-            raise Exception(_('%(name)s doesn\'t seems to be running.', name=self.name()))
+                if path:
+                    AudioPlayer._executable_paths[proc_name] = (proc.pid, info['create_time'], path)
 
-        return path
+                    return path
+
+        if access_denied:
+            raise Exception(_('%(name)s is running, but its location can\'t be determined (access denied).', name=self.name()))
+
+        raise Exception(_('%(name)s doesn\'t seems to be running.', name=self.name()))
 
     @staticmethod
     def name():
@@ -85,12 +134,38 @@ class AudioPlayer:
     def is_now_playing_supported():
         raise NotImplementedError('Must be implemented')
 
+    @staticmethod
+    def is_now_playing_pushed(config):
+        """Whether the audio player, with the given configuration, pushes the currently playing song. In which case
+        ``get_now_playing`` doesn't perform any I/O once ``listen`` has been called."""
+        return False
+
+    def listen(self):
+        """Start listening to the currently playing song changes, if supported."""
+        pass
+
     def get_now_playing(self):
         raise NotImplementedError('Must be implemented')
 
+    def add_now_playing_listener(self, listener):
+        """Call ``listener`` with the new currently playing song every time it changes. Only if the currently playing
+        song is pushed."""
+        raise NotImplementedError('Must be implemented')
+
     def queue(self, file):
         raise NotImplementedError('Must be implemented')
 
+    def queue_many(self, files):
+        """Queue several files at once, in order. Audio players able to do it in a single call override this.
+
+        Raises ``QueueError`` if only some of them may have been queued.
+        """
+        for i, file in enumerate(files):
+            try:
+                self.queue(file)
+            except Exception as e:
+                raise QueueError(str(e), list(range(i, len(files)))) from e
+
 
 class Aimp(AudioPlayer):
     """AIMP wrapper for CrowdMixer.
@@ -147,90 +222,344 @@ class Audacious(AudioPlayer):
         return False
 
     def queue(self, file):
+        self.queue_many([file])
+
+    def queue_many(self, files):
         audacious_path = self._get_executable_path('audacious')
 
         args = [
             audacious_path,
-            '--enqueue',
-            file
+            '--enqueue'
         ]
 
-        self._run_process(args)
+        args.extend(files)
 
+        self._run_process(args)
 
-class Clementine(AudioPlayer):
-    """Clementine wrapper for CrowdMixer.
 
-    **Method used to add a song:** TCP
-    **Method used to get the currently playing song:** TCP
+class ClementineMessageReader:
+    """Read the length-prefixed messages sent by Clementine from a socket.
 
-    **Documentation:** https://github.com/clementine-player/Android-Remote/wiki/Developer-Documentation
+    Data is received straight into a reusable buffer, as much as available per call, so a single system call may
+    read several messages (or part of them). Messages are parsed directly from this buffer, without intermediate copy.
     """
-    def __init__(self, *args, **kwargs):
-        super(Clementine, self).__init__(*args, **kwargs)
+    HEADER = struct.Struct('>I')
+    BUFFER_SIZE = 64 * 1024
+    MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, sock, buffer_size=BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        self.start = 0 # Beginning of the data not parsed yet
+        self.end = 0 # End of the data received
+
+    def read(self):
+        """Return the next message, or None if the connection has been closed."""
+        if not self._fill(self.HEADER.size):
+            return None
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.config['ip'], self.config['port']))
+        (msg_length, ) = self.HEADER.unpack_from(self.buffer, self.start)
 
-    def _send_message(self, msg):
-        if self.socket is not None:
-            msg.version = 21
-            serialized = msg.SerializeToString()
-            data = struct.pack('>I', len(serialized)) + serialized
+        if msg_length > self.MAX_MESSAGE_SIZE:
+            raise ConnectionError('Message from Clementine too large ({} bytes)'.format(msg_length))
 
-            try:
-                self.socket.send(data)
-            except Exception as e:
-                logging.error(e)
-        else:
-            logging.error('Socket is closed')
+        frame_length = self.HEADER.size + msg_length
 
-    def _get_response(self, msg_types):
-        msgs = []
+        if not self._fill(frame_length):
+            return None
 
-        while True:
-            chunk = self.socket.recv(4)
+        msg_start = self.start + self.HEADER.size
 
-            if not chunk:
-                break
+        msg = clementine_protobuf.Message()
 
-            (msg_length, ) = struct.unpack(">I", chunk)
+        with memoryview(self.buffer) as view:
+            msg.ParseFromString(view[msg_start:msg_start + msg_length])
 
-            data = bytes()
+        self.start += frame_length
 
-            while len(data) < msg_length:
-                chunk = self.socket.recv(min(4096, msg_length - len(data)))
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        return msg
+
+    def _fill(self, length):
+        """Make sure at least ``length`` bytes are available in the buffer. Return False if the connection has been
+        closed before that."""
+        while self.end - self.start < length:
+            if self.start + length > len(self.buffer):
+                self._make_room(length)
+
+            with memoryview(self.buffer) as view:
+                received = self.sock.recv_into(view[self.end:])
+
+            if not received:
+                return False
+
+            self.end += received
+
+        return True
+
+    def _make_room(self, length):
+        """Move the pending data to the beginning of the buffer, growing it if it cannot hold ``length`` bytes."""
+        pending = self.end - self.start
+
+        if length > len(self.buffer):
+            buffer = bytearray(max(length, len(self.buffer) * 2))
+            buffer[:pending] = self.buffer[self.start:self.end]
+
+            self.buffer = buffer
+        else:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+
+        self.start = 0
+        self.end = pending
 
-                if not chunk:
-                    break
 
-                data += chunk
+class ClementineConnection:
+    """Long-lived connection to the Clementine remote control, shared by every Clementine wrapper of the process.
 
-            if not chunk:
-                break
+    It authenticates once, is kept alive and transparently reconnects when needed. Messages pushed by Clementine are
+    read by a background thread, which maintains an in-memory snapshot of the currently playing song. It is
+    thread-safe.
+    """
+    CONNECT_TIMEOUT = 2
+    SOCKET_TIMEOUT = 5 # Of every send and receive call
+    RESPONSE_TIMEOUT = 5
+    KEEP_ALIVE_INTERVAL = 10
+    READ_TIMEOUT = 30 # Clementine sends keep-alive messages every 10 seconds: it is gone if it didn't send anything since
+    RECONNECT_DELAY = 1
+
+    _connections = {}
+    _connections_lock = threading.Lock()
+
+    def __init__(self, ip, port, auth_code=None):
+        self.ip = ip
+        self.port = port
+        self.auth_code = auth_code
+        self.socket = None
+        self.lock = threading.RLock()
+        self.state_condition = threading.Condition()
+        self.state = None
+        self.song = None
+        self.now_playing = None
+        self.now_playing_listeners = []
+        self.supervisor_thread = None
+        self.supervisor_wakeup = threading.Event()
+        self.connection_error = None
+
+    @classmethod
+    def get(cls, ip, port, auth_code=None):
+        """Return the connection to the given Clementine instance, creating it if needed."""
+        key = (ip, port, auth_code)
+
+        with cls._connections_lock:
+            if key not in cls._connections:
+                cls._connections[key] = cls(ip, port, auth_code)
+
+            return cls._connections[key]
+
+    def start(self):
+        """Start the background thread connecting (and reconnecting) to Clementine and keeping the connection alive."""
+        with self.lock:
+            if self.supervisor_thread and self.supervisor_thread.is_alive():
+                return
+
+            self.supervisor_thread = threading.Thread(target=self._supervise, name='clementine-supervisor', daemon=True)
+            self.supervisor_thread.start()
+
+    def send(self, msg):
+        """Send a message to Clementine, reconnecting (once) if the connection has been lost."""
+        with self.lock:
+            self._ensure_connected()
 
             try:
-                msg = clementine_protobuf.Message()
-                msg.ParseFromString(data)
+                self._send(msg)
+            except OSError:
+                self._close()
+                self._ensure_connected()
+                self._send(msg)
 
-                logging.info('Got message {} from Clementine'.format(msg.type))
+    def get_now_playing(self, timeout=RESPONSE_TIMEOUT):
+        """Return the snapshot of the currently playing song (see ``Clementine.get_now_playing``).
 
-                if msg.type in msg_types:
-                    msgs.append(msg)
+        Only the first call may involve network I/O, as the snapshot is then updated by the messages pushed by
+        Clementine.
+        """
+        self.start()
 
-                    if len(msgs) == len(msg_types):
-                        return msgs
-            except Exception as e:
-                logging.error(e)
+        with self.state_condition:
+            if not self.state_condition.wait_for(lambda: (self.state is not None and self.song is not None) or self.connection_error, timeout):
+                raise TimeoutError('Clementine didn\'t answer in time')
+
+            if self.connection_error:
+                raise self.connection_error
+
+            return self.now_playing
+
+    def add_now_playing_listener(self, listener):
+        """Call ``listener`` (from the reader thread) with the new snapshot every time the currently playing song
+        changes."""
+        with self.state_condition:
+            self.now_playing_listeners.append(listener)
+
+    def _ensure_connected(self):
+        if self.socket:
+            return
+
+        sock = socket.create_connection((self.ip, self.port), timeout=self.CONNECT_TIMEOUT)
+        sock.settimeout(self.SOCKET_TIMEOUT)
+
+        self.socket = sock
 
-    def _connect(self):
         msg = clementine_protobuf.Message()
         msg.type = clementine_protobuf.CONNECT
-        msg.request_connect.auth_code = self.config['auth_code'] if self.config['auth_code'] else 0
+        msg.request_connect.auth_code = self.auth_code if self.auth_code else 0
         msg.request_connect.send_playlist_songs = False
         msg.request_connect.downloader = False
 
-        self._send_message(msg)
+        self._send(msg)
+
+        threading.Thread(target=self._read, args=(sock, ), name='clementine-reader', daemon=True).start()
+
+        with self.state_condition:
+            self.connection_error = None
+
+    def _send(self, msg):
+        msg.version = 21
+        serialized = msg.SerializeToString()
+
+        self.socket.sendall(struct.pack('>I', len(serialized)) + serialized)
+
+    def _close(self, sock=None):
+        """Close the current socket (only if it is the given one)."""
+        with self.lock:
+            if not self.socket or (sock and sock is not self.socket):
+                return
+
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+
+            self.socket = None
+
+            # Don't serve a snapshot that may not be accurate anymore, and fail fast until reconnected
+            with self.state_condition:
+                self.state = None
+                self.song = None
+                self.connection_error = ConnectionError('Lost the connection to Clementine')
+
+                self._update_now_playing()
+                self.state_condition.notify_all()
+
+            self.supervisor_wakeup.set()
+
+    def _read(self, sock):
+        reader = ClementineMessageReader(sock)
+        last_received_at = monotonic()
+
+        try:
+            while True:
+                try:
+                    msg = reader.read()
+                except socket.timeout: # Nothing lost: the next read resumes where this one stopped
+                    if monotonic() - last_received_at < self.READ_TIMEOUT:
+                        continue
+
+                    raise ConnectionError('Clementine didn\'t send anything for {} seconds'.format(self.READ_TIMEOUT))
+
+                if not msg:
+                    break
+
+                last_received_at = monotonic()
+
+                logging.info('Got message {} from Clementine'.format(msg.type))
+
+                with self.state_condition:
+                    if sock is not self.socket: # Replaced by a new connection in the meantime
+                        break
+
+                    if msg.type == clementine_protobuf.INFO:
+                        self.state = msg.response_clementine_info.state
+                    elif msg.type == clementine_protobuf.ENGINE_STATE_CHANGED:
+                        self.state = msg.response_engine_state_changed.state
+                    elif msg.type == clementine_protobuf.CURRENT_METAINFO:
+                        song_metadata = msg.response_current_metadata.song_metadata
+
+                        self.song = {
+                            'artist': song_metadata.artist,
+                            'title': song_metadata.title,
+                            'album': song_metadata.album,
+                            'filename': os.path.splitext(os.path.basename(song_metadata.filename))[0]
+                        }
+                    elif msg.type == clementine_protobuf.DISCONNECT:
+                        logging.error('Disconnected by Clementine (reason: {})'.format(msg.response_disconnect.reason_disconnect))
+
+                        break
+                    else:
+                        continue
+
+                    self._update_now_playing()
+                    self.state_condition.notify_all()
+        except OSError as e:
+            logging.error(e)
+        finally:
+            self._close(sock)
+
+    def _update_now_playing(self):
+        """Must be called with ``state_condition`` acquired."""
+        now_playing = self.song if self.state == clementine_protobuf.Playing else None
+
+        if now_playing == self.now_playing:
+            return
+
+        self.now_playing = now_playing
+
+        for listener in self.now_playing_listeners:
+            try:
+                listener(now_playing)
+            except Exception as e:
+                logging.error(e)
+
+    def _supervise(self):
+        while True:
+            with self.lock:
+                try:
+                    if self.socket:
+                        msg = clementine_protobuf.Message()
+                        msg.type = clementine_protobuf.KEEP_ALIVE
+
+                        self._send(msg)
+                    else:
+                        self._ensure_connected()
+                except OSError as e:
+                    logging.error(e)
+
+                    self._close()
+
+                    with self.state_condition:
+                        self.connection_error = e
+                        self.state_condition.notify_all()
+
+            # Woken up as soon as the connection is lost to reconnect right away, but not in a tight loop
+            if self.supervisor_wakeup.wait(self.KEEP_ALIVE_INTERVAL):
+                self.supervisor_wakeup.clear()
+
+                sleep(self.RECONNECT_DELAY)
+
+
+class Clementine(AudioPlayer):
+    """Clementine wrapper for CrowdMixer.
+
+    **Method used to add a song:** TCP
+    **Method used to get the currently playing song:** TCP (pushed by Clementine)
+
+    **Documentation:** https://github.com/clementine-player/Android-Remote/wiki/Developer-Documentation
+    """
+    def __init__(self, *args, **kwargs):
+        super(Clementine, self).__init__(*args, **kwargs)
+
+        self.connection = ClementineConnection.get(self.config['ip'], self.config['port'], self.config['auth_code'])
 
     @staticmethod
     def name():
@@ -240,37 +569,30 @@ class Clementine(AudioPlayer):
     def is_now_playing_supported():
         return True
 
-    def get_now_playing(self):
-        self._connect()
+    @staticmethod
+    def is_now_playing_pushed(config):
+        return True
 
-        info, metainfo = self._get_response([clementine_protobuf.INFO, clementine_protobuf.CURRENT_METAINFO])
+    def listen(self):
+        self.connection.start()
 
-        self.socket.close()
+    def get_now_playing(self):
+        return self.connection.get_now_playing()
 
-        if info.response_clementine_info.state != clementine_protobuf.Playing:
-            return None
-
-        return {
-            'artist': metainfo.response_current_metadata.song_metadata.artist,
-            'title': metainfo.response_current_metadata.song_metadata.title,
-            'album': metainfo.response_current_metadata.song_metadata.album,
-            'filename': os.path.splitext(os.path.basename(metainfo.response_current_metadata.song_metadata.filename))[0]
-        }
+    def add_now_playing_listener(self, listener):
+        self.connection.add_now_playing_listener(listener)
 
     def queue(self, file):
-        self._connect()
-
-        _, _ = self._get_response([clementine_protobuf.INFO, clementine_protobuf.CURRENT_METAINFO]) # We don't care about the responses here, so just pull them without doing anything
+        self.queue_many([file])
 
+    def queue_many(self, files):
         msg = clementine_protobuf.Message()
         msg.type = clementine_protobuf.INSERT_URLS
-        msg.request_insert_urls.urls.append(file)
+        msg.request_insert_urls.urls.extend(files)
         msg.request_insert_urls.play_now = False
         msg.request_insert_urls.enqueue = True
 
-        self._send_message(msg)
-
-        self.socket.close()
+        self.connection.send(msg)
 
 
 class Foobar2000(AudioPlayer):
@@ -290,15 +612,19 @@ class Foobar2000(AudioPlayer):
         return False
 
     def queue(self, file):
+        self.queue_many([file])
+
+    def queue_many(self, files):
         foobar2000_path = self._get_executable_path('foobar2000')
 
         args = [
             foobar2000_path,
             '/immediate',
-            '/add',
-            file
+            '/add'
         ]
 
+        args.extend(files)
+
         self._run_process(args)
 
 
@@ -359,19 +685,231 @@ class MusicBee(AudioPlayer):
         self._run_process(args)
 
 
+class MpdConnection:
+    """Persistent connections to a Music Player Daemon instance, shared by every Mpd wrapper of the process.
+
+    Commands are sent through a kept alive connection, used by a single thread at a time (others open their own if
+    needed). A second connection, used by a background thread, idles until MPD reports a change of the player or the
+    playlist, to maintain an in-memory snapshot of the currently playing song. It is thread-safe.
+    """
+    RESPONSE_TIMEOUT = 5
+    RECONNECT_INTERVAL = 5
+
+    _connections = {}
+    _connections_lock = threading.Lock()
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.client = None
+        self.client_lock = threading.Lock()
+        self.state_condition = threading.Condition()
+        self.now_playing = None
+        self.now_playing_known = False
+        self.now_playing_listeners = []
+        self.idle_thread = None
+        self.idle_thread_lock = threading.Lock()
+        self.connection_error = None
+
+    @classmethod
+    def get(cls, ip, port):
+        """Return the connection to the given MPD instance, creating it if needed."""
+        key = (ip, port)
+
+        with cls._connections_lock:
+            if key not in cls._connections:
+                cls._connections[key] = cls(ip, port)
+
+            return cls._connections[key]
+
+    @staticmethod
+    def connect(ip, port, timeout=RESPONSE_TIMEOUT):
+        """Connect to MPD. Socket operations of the returned client fail after ``timeout`` seconds (None: never)."""
+        client = musicpd.MPDClient()
+        client.socket_timeout = timeout
+        client.connect(ip, port)
+
+        return client
+
+    @staticmethod
+    def read_now_playing(client):
+        """Return the currently playing song (see ``Mpd.get_now_playing``) using the given client."""
+        status = client.status()
+
+        if status.get('state') != 'play':
+            return None
+
+        current_song = client.currentsong()
+
+        return {
+            'artist': current_song.get('artist'),
+            'title': current_song.get('title'),
+            'album': current_song.get('album'),
+            'filename': os.path.splitext(os.path.basename(current_song.get('file', '')))[0]
+        }
+
+    @staticmethod
+    def add_files(client, files):
+        """Add the given files to the playlist using the given client, in a single command list if there's several."""
+        if len(files) == 1:
+            client.add(files[0])
+
+            return
+
+        client.command_list_ok_begin()
+
+        for file in files:
+            client.add(file)
+
+        try:
+            client.command_list_end()
+        except musicpd.CommandError as e:
+            # MPD stops at the first failing command of the list (its index follows the @), previous ones are applied
+            failed_command = re.search(r'@(\d+)\]', str(e))
+
+            if not failed_command:
+                raise
+
+            raise QueueError(str(e), list(range(int(failed_command.group(1)), len(files)))) from e
+
+    def start(self):
+        """Start the background thread idling on its own connection."""
+        with self.idle_thread_lock:
+            if self.idle_thread and self.idle_thread.is_alive():
+                return
+
+            self.idle_thread = threading.Thread(target=self._idle, name='mpd-idle', daemon=True)
+            self.idle_thread.start()
+
+    def add(self, files):
+        """Add files to the playlist, reconnecting (once) if the connection has been lost."""
+        client = self._take_client()
+
+        try:
+            try:
+                self.add_files(client, files)
+            except (musicpd.ConnectionError, OSError):
+                # MPD closes the connections that didn't send anything for a while (connection_timeout)
+                self._disconnect(client)
+
+                client = None
+                client = self.connect(self.ip, self.port)
+
+                self.add_files(client, files)
+        except (musicpd.ConnectionError, OSError):
+            self._disconnect(client)
+
+            raise
+        except Exception:
+            self._give_back_client(client)
+
+            raise
+
+        self._give_back_client(client)
+
+    def get_now_playing(self, timeout=RESPONSE_TIMEOUT):
+        """Return the snapshot of the currently playing song (see ``Mpd.get_now_playing``)."""
+        self.start()
+
+        with self.state_condition:
+            if not self.state_condition.wait_for(lambda: self.now_playing_known or self.connection_error, timeout):
+                raise TimeoutError('MPD didn\'t answer in time')
+
+            if self.connection_error:
+                raise self.connection_error
+
+            return self.now_playing
+
+    def add_now_playing_listener(self, listener):
+        """Call ``listener`` (from the idle thread) with the new snapshot every time the currently playing song
+        changes."""
+        with self.state_condition:
+            self.now_playing_listeners.append(listener)
+
+    def _take_client(self):
+        """Return the kept alive client, or a new one if it doesn't exist or is being used. Connecting is done
+        without holding the lock, so a hung MPD only blocks the threads actually waiting for it."""
+        with self.client_lock:
+            client, self.client = self.client, None
+
+        if not client:
+            client = self.connect(self.ip, self.port)
+
+        return client
+
+    def _give_back_client(self, client):
+        """Keep the given client alive for the next commands, or close it if there's already one."""
+        with self.client_lock:
+            if not self.client:
+                self.client = client
+
+                return
+
+        self._disconnect(client)
+
+    @staticmethod
+    def _disconnect(client):
+        if not client:
+            return
+
+        try:
+            client.disconnect()
+        except (musicpd.MPDError, OSError):
+            pass
+
+    def _idle(self):
+        while True:
+            client = None
+
+            try:
+                client = self.connect(self.ip, self.port, None) # Idling may last forever
+
+                while True:
+                    self._set_now_playing(self.read_now_playing(client))
+
+                    client.idle('player', 'playlist') # Blocks until one of these changes
+            except (musicpd.MPDError, OSError) as e:
+                logging.error(e)
+
+                self._set_now_playing(None, e)
+
+            self._disconnect(client)
+
+            sleep(self.RECONNECT_INTERVAL)
+
+    def _set_now_playing(self, now_playing, error=None):
+        with self.state_condition:
+            self.connection_error = error
+            self.now_playing_known = error is None
+            self.state_condition.notify_all()
+
+            if now_playing == self.now_playing:
+                return
+
+            self.now_playing = now_playing
+
+            for listener in self.now_playing_listeners:
+                try:
+                    listener(now_playing)
+                except Exception as e:
+                    logging.error(e)
+
+
 class Mpd(AudioPlayer):
     """Music Player Daemon wrapper for CrowdMixer.
 
     **Method used to add a song:** TCP
-    **Method used to get the currently playing song:** TCP
+    **Method used to get the currently playing song:** TCP (pushed by MPD in persistent mode)
 
     **Documentation:** https://www.musicpd.org/doc/protocol/
     """
     def __init__(self, *args, **kwargs):
         super(Mpd, self).__init__(*args, **kwargs)
 
-        self.client = musicpd.MPDClient()
-        self.client.connect(self.config['ip'], self.config['port'])
+        if self.config.get('persistent'):
+            self.connection = MpdConnection.get(self.config['ip'], self.config['port'])
+        else:
+            self.connection = None
 
     @staticmethod
     def name():
@@ -381,27 +919,43 @@ class Mpd(AudioPlayer):
     def is_now_playing_supported():
         return True
 
-    def get_now_playing(self):
-        status = self.client.status()
+    @staticmethod
+    def is_now_playing_pushed(config):
+        return bool(config.get('persistent'))
 
-        if status.state != 'play':
-            self.client.disconnect()
-            return None
+    def listen(self):
+        if self.connection:
+            self.connection.start()
 
-        current_song = self.client.currentsong()
+    def get_now_playing(self):
+        if self.connection:
+            return self.connection.get_now_playing()
 
-        self.client.disconnect()
+        client = MpdConnection.connect(self.config['ip'], self.config['port'])
 
-        return {
-            'artist': current_song.artist,
-            'title': current_song.title,
-            'album': current_song.album,
-            'filename': None
-        }
+        try:
+            return MpdConnection.read_now_playing(client)
+        finally:
+            client.disconnect()
+
+    def add_now_playing_listener(self, listener):
+        self.connection.add_now_playing_listener(listener)
 
     def queue(self, file):
-        self.client.add(file)
-        self.client.disconnect()
+        self.queue_many([file])
+
+    def queue_many(self, files):
+        if self.connection:
+            self.connection.add(files)
+
+            return
+
+        client = MpdConnection.connect(self.config['ip'], self.config['port'])
+
+        try:
+            MpdConnection.add_files(client, files)
+        finally:
+            client.disconnect()
 
 
 class Rhythmbox(AudioPlayer):
@@ -416,7 +970,7 @@ class Rhythmbox(AudioPlayer):
         super(Rhythmbox, self).__init__(*args, **kwargs)
 
         self.common_args = [
-            'rhythmbox-client'
+            'rhythmbox-client',
             '--no-start',
             '--no-present'
         ]
@@ -434,10 +988,10 @@ class Rhythmbox(AudioPlayer):
 
         playing_format = playing_format_sep.join(['%tt', '%ta', '%at'])
 
-        args = self.common_args.extend([
+        args = self.common_args + [
             '--print-playing',
             '--print-playing-format=' + playing_format
-        ])
+        ]
 
         output = self._run_process(args, get_output=True)
 
@@ -454,14 +1008,83 @@ class Rhythmbox(AudioPlayer):
         }
 
     def queue(self, file):
-        args = self.common_args.extend([
-            '--enqueue',
-            file
-        ])
+        self.queue_many([file])
+
+    def queue_many(self, files):
+        args = self.common_args + ['--enqueue'] + files
 
         self._run_process(args)
 
 
+class VlcSession:
+    """HTTP session to the VLC web interface, shared by every Vlc wrapper of the process.
+
+    Connections are kept alive and pooled, and failed requests are retried with an exponential backoff. It is
+    thread-safe.
+    """
+    POOL_SIZE = 4
+
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+
+    def __init__(self, password, retries, retry_backoff):
+        self.session = requests.Session()
+        self.session.auth = ('', password)
+
+        # Only retry when the request has certainly not been processed by VLC (enqueuing isn't idempotent)
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            status_forcelist=(502, 503, 504),
+            backoff_factor=retry_backoff,
+            raise_on_status=False
+        )
+
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE, max_retries=retry)
+
+        self.session.mount('http://', self.adapter)
+
+    @classmethod
+    def get(cls, password, retries, retry_backoff):
+        """Return the session having the given settings, creating it if needed."""
+        key = (password, retries, retry_backoff)
+
+        with cls._sessions_lock:
+            if key not in cls._sessions:
+                cls._sessions[key] = cls(password, retries, retry_backoff)
+
+            return cls._sessions[key]
+
+    def request(self, method, url, params=None, timeout=None):
+        response = self.session.request(method, url, params=params, timeout=timeout)
+
+        response.raise_for_status()
+
+        return response.json()
+
+    def get_pool_stats(self):
+        """Return, for every VLC instance, the number of requests made and of connections opened to make them (the
+        lower, the better the reuse), as well as the number of connections currently idle in the pool."""
+        stats = {}
+        pools = self.adapter.poolmanager.pools
+
+        for key in pools.keys():
+            pool = pools.get(key)
+
+            if not pool:
+                continue
+
+            stats['{}:{}'.format(pool.host, pool.port)] = {
+                'requests': pool.num_requests,
+                'connections': pool.num_connections,
+                'idle_connections': len([conn for conn in list(pool.pool.queue) if conn]) if pool.pool else 0 # Free slots are None
+            }
+
+        return stats
+
+
 class Vlc(AudioPlayer):
     """VLC wrapper for CrowdMixer.
 
@@ -474,15 +1097,16 @@ class Vlc(AudioPlayer):
         super(Vlc, self).__init__(*args, **kwargs)
 
         self.endpoint = 'http://{}:{}/requests/'.format(self.config['ip'], self.config['port'])
+        self.timeout = (self.config.get('connect_timeout', 2), self.config.get('read_timeout', 2))
+        self.session = VlcSession.get(self.config['password'], self.config.get('retries', 2), self.config.get('retry_backoff', 0.2))
 
     def _query(self, method, resource, params=None):
         url = self.endpoint + resource + '.json'
 
-        response = requests.request(method, url, auth=('', self.config['password']), params=params, timeout=2)
+        return self.session.request(method, url, params=params, timeout=self.timeout)
 
-        response.raise_for_status()
-
-        return response.json()
+    def get_pool_stats(self):
+        return self.session.get_pool_stats()
 
     @staticmethod
     def name():
@@ -533,14 +1157,18 @@ class Winamp(AudioPlayer):
         return False
 
     def queue(self, file):
+        self.queue_many([file])
+
+    def queue_many(self, files):
         winamp_path = self._get_executable_path('winamp')
 
         args = [
             winamp_path,
-            '/ADD',
-            file
+            '/ADD'
         ]
 
+        args.extend(files)
+
         self._run_process(args)
 
 
@@ -594,6 +1222,22 @@ class Xmms2(AudioPlayer):
         }
 
     def queue(self, file):
-        self._get_result(self.client.playlist_add_url(file))
+        self.queue_many([file])
+
+    def queue_many(self, files):
+        # Send every command before waiting for their results
+        results = [self.client.playlist_add_url(file) for file in files]
+        failed = []
+        error = None
+
+        for i, result in enumerate(results):
+            result.wait()
+
+            if result.iserror():
+                failed.append(i)
+                error = result.get_error()
 
         self.client.quit()
+
+        if failed:
+            raise QueueError(error, failed)
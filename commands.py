@@ -1,11 +1,35 @@
 from crowdmixer import app, db
+from sqlalchemy.schema import CreateTable, CreateIndex
+from sqlalchemy import inspect, bindparam, MetaData
+from contextlib import contextmanager
+from multiprocessing import Pool
 from datetime import timedelta
 from tinytag import TinyTag
-from glob import glob
+from helpers import *
 from time import time
 from models import *
+import urllib.request
 import click
+import gzip
+import io
 import os
+import re
+
+# Optional modules/packages
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SHADOW_SONGS_TABLE = 'songs_new'
+SHADOW_SONGS_FTS_TABLE = 'songs_fts_new'
+
+FONT_AWESOME_URL = 'https://maxcdn.bootstrapcdn.com/font-awesome/4.7.0/'
+FONT_AWESOME_FONTS = {'woff2': 'fontawesome-webfont.woff2', 'woff': 'fontawesome-webfont.woff'}
+KNACSS_URL = 'https://cdn.jsdelivr.net/gh/alsacreations/KNACSS@6.1.2/css/knacss.css'
+# Strings, unquoted url() values and comments, which must not be minified
+CSS_PRESERVED_TOKENS = re.compile(r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\'|url\(\s*[^\s"\')][^)]*\)|/\*.*?\*/', re.DOTALL | re.IGNORECASE)
+PRECOMPRESSED_EXTENSIONS = ('.css', '.js', '.svg', '.ico', '.ttf', '.eot', '.json', '.txt')
 
 
 @app.cli.command()
@@ -27,87 +51,686 @@ def create_database():
     click.secho('Done', fg='green')
 
 
+@app.cli.command()
+def migrate_database():
+    """Add the missing columns to an existing database without losing data."""
+    existing_columns = [column['name'] for column in inspect(db.engine).get_columns(Song.__tablename__)]
+
+    for column in Song.__table__.columns:
+        if column.name in existing_columns:
+            continue
+
+        click.echo('Adding column {}'.format(column.name))
+
+        db.engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+            Song.__tablename__,
+            column.name,
+            column.type.compile(dialect=db.engine.dialect)
+        ))
+
+    existing_indexes = [index['name'] for index in inspect(db.engine).get_indexes(Song.__tablename__)]
+
+    for index in Song.__table__.indexes:
+        if index.name in existing_indexes:
+            continue
+
+        if index.unique and 'path' in index.columns:
+            result = db.engine.execute('DELETE FROM {0} WHERE id NOT IN (SELECT MIN(id) FROM {0} GROUP BY path)'.format(Song.__tablename__))
+
+            if result.rowcount:
+                click.echo('Removed {} duplicate songs'.format(result.rowcount))
+
+        click.echo('Creating index {}'.format(index.name))
+
+        index.create(db.engine)
+
+    if not is_songs_fts_supported(db.engine.execute):
+        click.secho('SQLite hasn\'t been compiled with FTS5, search will be slower', fg='yellow')
+    elif not db.engine.has_table(SONGS_FTS_TABLE):
+        click.echo('Creating the full-text search index')
+
+        with db.engine.begin() as connection:
+            create_songs_fts(connection.execute)
+
+    click.secho('Done', fg='green')
+
+
 @app.cli.command()
 @click.option('--min_duration', default=None, help='Don\'t index songs with a duration greater than this value (format: MM(:SS))')
 @click.option('--max_duration', default=None, help='Don\'t index songs with a duration smaller than this value (format: MM(:SS))')
-def index(min_duration=None, max_duration=None):
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of processes used to read the songs tags (default: 1)')
+@click.option('--incremental', is_flag=True, help='Only read new and modified songs, and keep the votes of the existing ones')
+@click.option('--batch_size', default=1000, type=click.IntRange(min=1), help='Number of songs written to the database at once (default: 1000)')
+def index(min_duration=None, max_duration=None, workers=1, incremental=False, batch_size=1000):
     """Index songs in the configured directories."""
-    Song.query.delete()
-    db.session.commit()
+    songs_table = Song.__table__
+
+    if incremental and (min_duration or max_duration):
+        # Durations aren't stored: unchanged songs couldn't be filtered, and ignored ones would be read on every run
+        click.secho('--incremental can\'t be used along --min_duration or --max_duration', fg='red')
+
+        return
+
+    if incremental:
+        # Path => (ID, size, modification time) of every song currently indexed. Remaining entries once the scan is
+        # finished are the songs that doesn't exist anymore
+        indexed_songs = {path: (song_id, size, mtime) for song_id, path, size, mtime in db.session.query(Song.id, Song.path, Song.size, Song.mtime)}
+    else:
+        indexed_songs = {}
+
+        # Path => ID of every song currently indexed. Songs keep their ID in the shadow table, so the pages loaded
+        # before the swap and the pending queue jobs keep referring to the same songs. New ones get IDs above the current ones
+        songs_ids = dict(db.session.query(Song.path, Song.id)) if db.engine.has_table(songs_table.name) else {}
+        next_song_id = max(songs_ids.values(), default=0) + 1
 
     music_dirs = app.config['MUSIC_DIRS']
     supported_audio_formats = app.config['SUPPORTED_AUDIO_FORMATS']
 
     click.echo('{} directories configured'.format(len(music_dirs)))
 
-    songs = []
-
     min_duration = parse_duration(min_duration)
     max_duration = parse_duration(max_duration)
 
-    start = time()
+    songs_stats = {}
+    updated_songs_ids = {}
+    unchanged_songs = 0
+    unreadable_dirs = [] # Indexed songs under these directories are kept, as we don't know if they still exist
 
-    for music_dir in music_dirs:
-        click.echo('Scanning ' + music_dir)
+    def scan_songs():
+        """Lazily yield the songs that need to be read, in a single pass over each configured directory."""
+        nonlocal unchanged_songs
 
-        if not os.path.isdir(music_dir):
-            app.logger.warning(music_dir + ' isn\'t a directory or doesn\'t exists')
-            continue
+        for music_dir in music_dirs:
+            click.echo('Scanning ' + music_dir)
+
+            if not os.path.isdir(music_dir):
+                app.logger.warning(music_dir + ' isn\'t a directory or doesn\'t exists')
+
+                unreadable_dirs.append(music_dir) # May be an unmounted drive or share
+                continue
+
+            for song in walk_audio_files(music_dir, supported_audio_formats, unreadable_dirs):
+                if song in songs_stats: # Configured directories are overlapping
+                    continue
+
+                try:
+                    song_stat = os.stat(song)
+                except OSError as e:
+                    click.echo('{}: {}'.format(song, e), err=True)
+
+                    continue
 
-        for audio_format in supported_audio_formats:
-            songs.extend(glob(os.path.join(music_dir, '**', '*.' + audio_format), recursive=True))
+                songs_stats[song] = (song_stat.st_size, song_stat.st_mtime)
 
-    click.echo('{} supported audio files detected'.format(len(songs)))
+                if song in indexed_songs:
+                    song_id, size, mtime = indexed_songs.pop(song)
 
-    for songs_chunk in list(chunks(songs, 100)):
-        for song in songs_chunk:
-            try:
-                song_tags = TinyTag.get(song)
+                    if (size, mtime) == songs_stats[song]:
+                        unchanged_songs += 1
 
-                if min_duration and song_tags.duration < min_duration:
+                        continue
+
+                    updated_songs_ids[song] = song_id
+
+                yield song
+
+    start = time()
+
+    songs_to_read = scan_songs()
+
+    pool = None
+
+    if workers > 1:
+        click.echo('Reading tags using {} processes'.format(workers))
+
+        pool = Pool(workers)
+
+        # Tags are parsed by the pool and streamed back here as soon as they are ready, so this process is the only
+        # one writing to the database
+        songs_tags = pool.imap_unordered(read_song_tags, songs_to_read, chunksize=50)
+    else:
+        songs_tags = map(read_song_tags, songs_to_read)
+
+    new_songs_rows = []
+    updated_songs_rows = []
+    new_songs = 0
+
+    if incremental:
+        insert_songs = songs_table.insert()
+    else:
+        # Songs are indexed into a shadow table which then atomically replaces the current one, so the songs stay
+        # available while indexing
+        shadow_songs_table = songs_table.tometadata(MetaData(), name=SHADOW_SONGS_TABLE)
+
+        insert_songs = shadow_songs_table.insert()
+    update_songs = songs_table.update().where(songs_table.c.id == bindparam('_id')).values(
+        title=bindparam('title'),
+        artist=bindparam('artist'),
+        album=bindparam('album'),
+        size=bindparam('size'),
+        mtime=bindparam('mtime')
+    )
+
+    def flush_songs(connection):
+        # SQLite locks the whole database while writing, not only the written table: every batch is committed on its
+        # own so votes can still be saved in between
+        with connection.begin():
+            if new_songs_rows:
+                connection.execute(insert_songs, new_songs_rows)
+                new_songs_rows.clear()
+
+            if updated_songs_rows:
+                connection.execute(update_songs, updated_songs_rows)
+                updated_songs_rows.clear()
+
+    with bulk_writes_connection() as connection:
+        if not incremental:
+            connection.execute('DROP TABLE IF EXISTS {}'.format(SHADOW_SONGS_TABLE))
+            connection.execute(CreateTable(shadow_songs_table))
+
+        try:
+            for song, song_tags, error in songs_tags:
+                if error:
+                    click.echo('{}: {}'.format(song, error), err=True)
+
+                    # Keep the indexed song as-is, it will be read again on the next run
+                    updated_songs_ids.pop(song, None)
+
+                    continue
+
+                if (min_duration or max_duration) and song_tags['duration'] is None:
+                    click.echo('Ignoring {} because its duration is unknown'.format(song))
+
+                    continue
+
+                if min_duration and song_tags['duration'] < min_duration:
                     click.echo('Ignoring {} because duration is under the minimal required'.format(song))
 
                     continue
 
-                if max_duration and song_tags.duration > max_duration:
+                if max_duration and song_tags['duration'] > max_duration:
                     click.echo('Ignoring {} because duration is above the maximal allowed'.format(song))
 
                     continue
 
-                if song_tags.artist and not song_tags.albumartist or song_tags.artist and song_tags.albumartist:
-                    artist = song_tags.artist
-                elif not song_tags.artist and song_tags.albumartist:
-                    artist = song_tags.albumartist
-                else:
-                    artist = None
+                size, mtime = songs_stats[song]
 
-                if not song_tags.title:
-                    title = os.path.splitext(os.path.basename(song))[0]
-                else:
-                    title = song_tags.title
+                values = {
+                    'title': song_tags['title'],
+                    'artist': song_tags['artist'],
+                    'album': song_tags['album'],
+                    'size': size,
+                    'mtime': mtime
+                }
+
+                click.echo('{} - {} ({})'.format(song_tags['artist'], song_tags['title'], song_tags['album']))
+
+                if song in updated_songs_ids:
+                    values['_id'] = updated_songs_ids[song]
 
-                if not song_tags.album:
-                    album = None
+                    updated_songs_rows.append(values)
                 else:
-                    album = song_tags.album
+                    values['path'] = song
+
+                    if not incremental:
+                        values['id'] = songs_ids.get(song)
+
+                        if values['id'] is None:
+                            values['id'] = next_song_id
+                            next_song_id += 1
+
+                    new_songs_rows.append(values)
+
+                    new_songs += 1
+
+                if len(new_songs_rows) + len(updated_songs_rows) >= batch_size:
+                    flush_songs(connection)
+
+            flush_songs(connection)
+        except BaseException:
+            if pool: # Don't wait for the remaining songs to be read
+                pool.terminate()
+                pool.join()
+
+            raise
+
+        if pool:
+            pool.close()
+            pool.join()
+
+        # Songs that vanished from the disk
+        unreadable_dirs = tuple(os.path.join(unreadable_dir, '') for unreadable_dir in unreadable_dirs)
+        removed_songs_ids = [song_id for path, (song_id, size, mtime) in indexed_songs.items() if not path.startswith(unreadable_dirs)]
 
-                song_object = Song(
-                    title=title,
-                    artist=artist,
-                    album=album,
-                    path=song
-                )
+        with connection.begin():
+            for removed_songs_ids_chunk in chunks(removed_songs_ids, 500):
+                connection.execute(songs_table.delete().where(songs_table.c.id.in_(removed_songs_ids_chunk)))
 
-                click.echo('{} - {} ({})'.format(artist, title, album))
+    if not incremental:
+        click.echo('Replacing the songs table')
 
-                db.session.add(song_object)
-            except Exception as e:
-                click.echo('{}: {}'.format(song, e), err=True)
+        swap_songs_table(batch_size)
 
-        db.session.commit()
+    bump_data_version()
+
+    click.echo('{} supported audio files detected'.format(len(songs_stats)))
+
+    if incremental:
+        click.echo('{} new, {} updated, {} unchanged, {} removed'.format(new_songs, len(updated_songs_ids), unchanged_songs, len(removed_songs_ids)))
+
+        if unreadable_dirs:
+            click.secho('{} directories couldn\'t be read, their songs have been kept'.format(len(unreadable_dirs)), fg='yellow')
 
     end = time()
 
     duration = end - start
 
     click.secho('Duration: {}'.format(timedelta(seconds=duration)), fg='green')
+
+
+@app.cli.command()
+@click.option('--runs', default=20, type=click.IntRange(min=1), help='Number of times each query is ran (default: 20)')
+def benchmark_songs_list(runs=20):
+    """Show the query plan and the duration of the songs list queries."""
+    connection = db.engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+
+        for mode in ['Vote', 'Immediate']:
+            order_by_votes = mode == 'Vote'
+            first_page = Song.query.search_keyset_paginated(order_by_votes=order_by_votes)
+
+            queries = [
+                ('first page', Song.query.search(order_by_votes=order_by_votes).limit(app.config['SONGS_PER_PAGE']))
+            ]
+
+            if first_page.next_cursor:
+                queries.append(('next page (keyset)', Song.query.search_keyset(order_by_votes=order_by_votes, cursor=first_page.next_cursor)[0].limit(app.config['SONGS_PER_PAGE'] + 1)))
+
+            for name, query in queries:
+                click.secho('{} mode, {}'.format(mode, name), bold=True)
+
+                statement = query.statement.compile(dialect=db.engine.dialect)
+                params = [statement.params[param] for param in statement.positiontup]
+
+                for row in cursor.execute('EXPLAIN QUERY PLAN ' + str(statement), params).fetchall():
+                    click.secho('  ' + row[-1], fg='red' if 'TEMP B-TREE' in row[-1] else None)
+
+                start = time()
+
+                for i in range(runs):
+                    cursor.execute(str(statement), params).fetchall()
+
+                click.echo('  {:.3f} ms per query'.format((time() - start) * 1000 / runs))
+    finally:
+        connection.close()
+
+
+@app.cli.command()
+@click.option('--requests', default=20, type=click.IntRange(min=1), help='Number of requests made to VLC (default: 20)')
+def vlc_pool_stats(requests=20):
+    """Request VLC several times, then show how many connections were opened to do it."""
+    if app.config['PLAYER_TO_USE'] != 'Vlc':
+        click.secho('VLC isn\'t the audio player in use', fg='red')
+
+        return
+
+    audio_player = get_current_audio_player_instance()
+
+    start = time()
+
+    for i in range(requests):
+        audio_player.get_now_playing()
+
+    click.echo('{:.3f} ms per request'.format((time() - start) * 1000 / requests))
+
+    for host, stats in audio_player.get_pool_stats().items():
+        click.secho(host, bold=True)
+        click.echo('  {} requests using {} connections, {} idle'.format(stats['requests'], stats['connections'], stats['idle_connections']))
+
+
+@app.cli.command()
+@click.option('--source_dir', default=None, type=click.Path(exists=True, file_okay=False), help='Read the third-party files (font-awesome.min.css, fontawesome-webfont.woff2, fontawesome-webfont.woff and knacss.css) from this directory instead of downloading them')
+def build_assets(source_dir=None):
+    """Vendor, subset, minify and precompress the front-end assets, so they are served locally."""
+    static_dir = app.static_folder
+    font_awesome_dir = os.path.join(static_dir, 'vendor', 'font-awesome')
+    knacss_dir = os.path.join(static_dir, 'vendor', 'knacss')
+
+    os.makedirs(os.path.join(font_awesome_dir, 'css'), exist_ok=True)
+    os.makedirs(os.path.join(font_awesome_dir, 'fonts'), exist_ok=True)
+    os.makedirs(knacss_dir, exist_ok=True)
+
+    def fetch(url):
+        if source_dir:
+            with open(os.path.join(source_dir, url.rsplit('/', 1)[-1]), 'rb') as f:
+                return f.read()
+
+        click.echo('Downloading ' + url)
+
+        with urllib.request.urlopen(url, timeout=30) as response:
+            return response.read()
+
+    # Font Awesome: only keep the icons used by the templates and scripts
+    icons = get_used_font_awesome_icons(app.jinja_loader.searchpath + [static_dir])
+
+    click.echo('{} Font Awesome icons used: {}'.format(len(icons), ', '.join(sorted(icons))))
+
+    font_awesome_css, codepoints = subset_font_awesome_css(fetch(FONT_AWESOME_URL + 'css/font-awesome.min.css').decode('utf-8'), icons)
+
+    fonts = []
+
+    for flavor, font_name in FONT_AWESOME_FONTS.items():
+        font_path = os.path.join(font_awesome_dir, 'fonts', font_name)
+        font = fetch(FONT_AWESOME_URL + 'fonts/' + font_name)
+
+        try:
+            font = subset_font(font, codepoints, flavor)
+        except ImportError as e:
+            click.secho('Font not subsetted ({}): install fontTools (and brotli for WOFF2)'.format(e), fg='yellow')
+
+        with open(font_path, 'wb') as f:
+            f.write(font)
+
+        fonts.append((flavor, 'fonts/' + font_name))
+
+    # Fonts URLs are versioned as they cannot be generated by url_for()
+    font_face_src = ','.join([
+        'url(\'../{}?v={}\') format(\'{}\')'.format(font_file, get_static_file_hash('vendor/font-awesome/' + font_file), flavor) for flavor, font_file in fonts
+    ])
+
+    font_awesome_css = re.sub(r'@font-face\s*\{[^}]*\}', lambda m: '@font-face{font-family:\'FontAwesome\';src:' + font_face_src + ';font-weight:normal;font-style:normal}', font_awesome_css)
+
+    with open(os.path.join(static_dir, 'css', 'app.css'), encoding='utf-8') as f:
+        app_css = f.read()
+
+    assets = {
+        os.path.join(font_awesome_dir, 'css', 'font-awesome.min.css'): minify_css(font_awesome_css),
+        os.path.join(knacss_dir, 'knacss.min.css'): minify_css(fetch(KNACSS_URL).decode('utf-8')),
+        os.path.join(static_dir, 'css', 'app.min.css'): minify_css(app_css)
+    }
+
+    for path, css in assets.items():
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(css)
+
+        click.echo('{} ({} bytes)'.format(os.path.relpath(path, static_dir), len(css.encode('utf-8'))))
+
+    # Compressed once here, so the web server doesn't have to do it for every request
+    if not brotli:
+        click.secho('brotli isn\'t installed: only gzip-compressed files will be generated', fg='yellow')
+
+    for directory, dirnames, filenames in os.walk(static_dir):
+        for filename in filenames:
+            if filename.lower().endswith(PRECOMPRESSED_EXTENSIONS):
+                precompress_file(os.path.join(directory, filename))
+
+    click.secho('Done', fg='green')
+
+
+@contextmanager
+def bulk_writes_connection():
+    """Open a connection tuned for bulk writes. Transactions are left to the caller, which should keep them short as
+    they block every other writer.
+
+    Only the durability of the last transactions is traded for speed: in WAL mode, a crash or a power loss may undo them
+    but can't corrupt the database, which also holds the votes and queue history.
+    """
+    connection = db.engine.connect()
+
+    try:
+        # Lets the web app keep reading the songs while they are being indexed. Persists in the database file (see the
+        # README): switching back would require every other connection to be closed
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        connection.execute('PRAGMA temp_store = MEMORY')
+        connection.execute('PRAGMA cache_size = -65536') # 64 MiB
+
+        yield connection
+    finally:
+        connection.close()
+
+
+def swap_songs_table(batch_size=1000):
+    """Replace the songs table by the shadow one filled by the indexer.
+
+    What takes time (filling the full-text search index, building the indexes) is done beforehand in short transactions,
+    so votes can still be saved in between. Then, in a single transaction, votes and queue counters are carried over by
+    path and the tables are swapped: readers either see the old songs or the new ones.
+    """
+    songs_table = Song.__table__
+    shadow_songs_table = songs_table.tometadata(MetaData(), name=SHADOW_SONGS_TABLE)
+    connection = db.engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+
+        fts = cursor.execute('SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = ?', (SONGS_FTS_TABLE, )).fetchone() is not None
+
+        # The sqlite3 module doesn't open transactions for DDL statements on its own
+        if fts:
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(SHADOW_SONGS_FTS_TABLE))
+            create_songs_fts_table(cursor.execute, SHADOW_SONGS_FTS_TABLE)
+
+            last_id = 0
+
+            while True:
+                cursor.execute('BEGIN IMMEDIATE')
+
+                upper_id = cursor.execute('SELECT MAX(id) FROM (SELECT id FROM {} WHERE id > ? ORDER BY id LIMIT ?)'.format(SHADOW_SONGS_TABLE), (last_id, batch_size)).fetchone()[0]
+
+                if upper_id is None:
+                    connection.commit()
+
+                    break
+
+                cursor.execute('INSERT INTO {} (rowid, title, artist, album) SELECT id, title, artist, album FROM {} WHERE id > ? AND id <= ?'.format(SHADOW_SONGS_FTS_TABLE, SHADOW_SONGS_TABLE), (last_id, upper_id))
+
+                connection.commit()
+
+                last_id = upper_id
+
+        # SQLite can't rename indexes: each one of the current table is dropped right before being built on the shadow
+        # one. The songs list is slower to query in the meantime, but votes are only blocked while one is built
+        for index in shadow_songs_table.indexes:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('DROP INDEX IF EXISTS {}'.format(index.name))
+            cursor.execute(CreateIndex(index).compile(dialect=db.engine.dialect).string)
+
+            connection.commit()
+
+        cursor.execute('BEGIN IMMEDIATE')
+
+        cursor.execute('DROP TABLE IF EXISTS temp.songs_counters')
+        cursor.execute('CREATE TEMP TABLE songs_counters AS SELECT path, votes, total_times_queued, last_queued_at FROM {} WHERE votes > 0 OR total_times_queued > 0 OR last_queued_at IS NOT NULL'.format(songs_table.name))
+        cursor.execute('CREATE INDEX temp.ix_songs_counters_path ON songs_counters (path)')
+
+        cursor.execute('''UPDATE {0} SET
+            votes = (SELECT votes FROM songs_counters WHERE songs_counters.path = {0}.path),
+            total_times_queued = (SELECT total_times_queued FROM songs_counters WHERE songs_counters.path = {0}.path),
+            last_queued_at = (SELECT last_queued_at FROM songs_counters WHERE songs_counters.path = {0}.path)
+        WHERE path IN (SELECT path FROM songs_counters)'''.format(SHADOW_SONGS_TABLE))
+
+        # The full-text search index triggers are dropped along the old table
+        cursor.execute('DROP TABLE {}'.format(songs_table.name))
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(SHADOW_SONGS_TABLE, songs_table.name))
+
+        if fts:
+            cursor.execute('DROP TABLE {}'.format(SONGS_FTS_TABLE))
+            cursor.execute('ALTER TABLE {} RENAME TO {}'.format(SHADOW_SONGS_FTS_TABLE, SONGS_FTS_TABLE))
+
+            create_songs_fts_triggers(cursor.execute)
+
+        connection.commit()
+
+        cursor.execute('DROP TABLE temp.songs_counters')
+    except Exception:
+        # Failing to clean up mustn't hide why the swap failed
+        try:
+            connection.rollback()
+
+            # Give its indexes back to the current table
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(SHADOW_SONGS_FTS_TABLE))
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(SHADOW_SONGS_TABLE))
+
+            for index in songs_table.indexes:
+                if not cursor.execute('SELECT 1 FROM sqlite_master WHERE type = \'index\' AND name = ?', (index.name, )).fetchone():
+                    cursor.execute(CreateIndex(index).compile(dialect=db.engine.dialect).string)
+        except Exception as e:
+            app.logger.error(e)
+
+        raise
+    finally:
+        connection.close()
+
+
+def read_song_tags(song):
+    """Read the tags of the given song file.
+
+    Used by the indexer, possibly from a worker process: it must not touch the database. Returns a tuple made of the
+    song path, its tags (or None) and the error message (or None).
+    """
+    try:
+        song_tags = TinyTag.get(song)
+    except Exception as e:
+        return song, None, str(e)
+
+    if song_tags.artist and not song_tags.albumartist or song_tags.artist and song_tags.albumartist:
+        artist = song_tags.artist
+    elif not song_tags.artist and song_tags.albumartist:
+        artist = song_tags.albumartist
+    else:
+        artist = None
+
+    if not song_tags.title:
+        title = os.path.splitext(os.path.basename(song))[0]
+    else:
+        title = song_tags.title
+
+    if not song_tags.album:
+        album = None
+    else:
+        album = song_tags.album
+
+    return song, {
+        'title': title,
+        'artist': artist,
+        'album': album,
+        'duration': song_tags.duration
+    }, None
+
+
+def get_used_font_awesome_icons(directories):
+    """Return the names of the Font Awesome icons (e.g. ``fa-book``) referenced in the files of the given directories."""
+    icons = set()
+
+    for directory in directories:
+        for root, dirnames, filenames in os.walk(directory):
+            if os.path.basename(root) == 'vendor':
+                dirnames[:] = []
+
+                continue
+
+            for filename in filenames:
+                if filename.endswith(('.html', '.js')):
+                    with open(os.path.join(root, filename), encoding='utf-8') as f:
+                        icons.update(re.findall(r'\bfa-[a-z0-9-]+', f.read()))
+
+    return icons
+
+
+def subset_font_awesome_css(css, icons):
+    """Remove the rules of the Font Awesome icons that aren't in ``icons``. Returns the CSS and the code points of the
+    remaining icons."""
+    codepoints = set()
+
+    def subset_rule(match):
+        selectors = [selector.strip() for selector in match.group(1).split(',')]
+
+        if not all(re.match(r'^\.fa-[a-z0-9-]+:before$', selector) for selector in selectors): # Not an icon
+            return match.group(0)
+
+        selectors = [selector for selector in selectors if selector[1:-len(':before')] in icons]
+
+        if not selectors:
+            return ''
+
+        codepoint = re.search(r'content:\s*"\\([0-9a-f]+)"', match.group(2))
+
+        if codepoint:
+            codepoints.add(int(codepoint.group(1), 16))
+
+        return ','.join(selectors) + '{' + match.group(2) + '}'
+
+    return re.sub(r'([^{}]+)\{([^{}]*)\}', subset_rule, css), codepoints
+
+
+def subset_font(font, codepoints, flavor):
+    """Only keep the glyphs of the given code points in a font (raises ImportError if fontTools isn't available)."""
+    from fontTools import subset
+
+    options = subset.Options()
+    options.flavor = flavor
+
+    font = subset.load_font(io.BytesIO(font), options)
+
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=codepoints)
+    subsetter.subset(font)
+
+    output = io.BytesIO()
+
+    subset.save_font(font, output, options)
+
+    return output.getvalue()
+
+
+def minify_css(css):
+    """Remove comments (except the /*! ones, usually holding licenses) and unneeded whitespace from CSS. Strings and
+    url() values are left untouched."""
+    preserved = []
+
+    def preserve(match):
+        token = match.group(0)
+
+        if token.startswith('/*') and not token.startswith('/*!'):
+            return ''
+
+        preserved.append(token)
+
+        return '\0{}\0'.format(len(preserved) - 1)
+
+    css = CSS_PRESERVED_TOKENS.sub(preserve, css)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    css = re.sub(r'\{[^{}]*\}', lambda m: re.sub(r'\s+:', ':', m.group(0)), css) # Declarations only, not selectors
+    css = css.replace(';}', '}').strip()
+
+    return re.sub(r'\0(\d+)\0', lambda m: preserved[int(m.group(1))], css)
+
+
+def precompress_file(path):
+    """Write the gzip (.gz) and Brotli (.br, if available) compressed versions of a file next to it, if smaller."""
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    compressed = {}
+
+    gzip_buffer = io.BytesIO()
+
+    with gzip.GzipFile(fileobj=gzip_buffer, mode='wb', compresslevel=9, mtime=0) as f: # mtime=0: reproducible output
+        f.write(content)
+
+    compressed['.gz'] = gzip_buffer.getvalue()
+
+    if brotli:
+        compressed['.br'] = brotli.compress(content, quality=11)
+
+    for extension, data in compressed.items():
+        if len(data) < len(content):
+            with open(path + extension, 'wb') as f:
+                f.write(data)
+        elif os.path.isfile(path + extension): # Outdated
+            os.remove(path + extension)
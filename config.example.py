@@ -5,12 +5,23 @@ CACHE_THRESHOLD = 800
 TITLE = None
 MUSIC_DIRS = []
 NOW_PLAYING_CACHE_TIME = 60
+NOW_PLAYING_STALE_TIME = 300
 MODE = 'Vote'
 VOTES_THRESHOLD = 3
 BLOCK_TIME = 7200
 REQUEST_LIMIT = 900
+ASYNC_QUEUE = True
+ASYNC_QUEUE_MAX_SIZE = 50
+ASYNC_QUEUE_RETRIES = 2
+ASYNC_QUEUE_RETRY_DELAY = 1
 SHOW_CURRENT_PLAYING = True
+LIVE_UPDATES = False
+LIVE_UPDATES_MAX_CLIENTS = 10
 SONGS_PER_PAGE = 10
+KEYSET_PAGINATION = True
+SONGS_COUNT_CACHE_TIME = 3600
+SONGS_COUNT_CAP = 1000
+SONGS_LIST_CACHE_TIME = 30
 PLAYER_TO_USE = 'Clementine'
 PLAYERS = {
     'Clementine': {
@@ -21,10 +32,15 @@ PLAYERS = {
     'Vlc': {
         'ip': '127.0.0.1',
         'port': 8080,
-        'password': ''
+        'password': '',
+        'connect_timeout': 2,
+        'read_timeout': 2,
+        'retries': 2,
+        'retry_backoff': 0.2
     },
     'Mpd': {
         'ip': '127.0.0.1',
-        'port': 6600
+        'port': 6600,
+        'persistent': True
     }
 }
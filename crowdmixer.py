@@ -40,6 +40,8 @@ app.config['SUPPORTED_AUDIO_FORMATS'] = [
 db = SQLAlchemy(app)
 babel = Babel(app)
 cache = Cache(app)
+versions_cache = Cache(app, config={'CACHE_DIR': 'storage/versions', 'CACHE_THRESHOLD': 100}) # Holds too few items to be pruned
+queue_jobs_cache = Cache(app, config={'CACHE_DIR': 'storage/queue_jobs', 'CACHE_THRESHOLD': 1000}) # Far more than the songs queued in an hour
 
 handler = RotatingFileHandler('storage/logs/errors.log', maxBytes=10000000, backupCount=2)
 handler.setLevel(logging.WARNING)
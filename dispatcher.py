@@ -0,0 +1,154 @@
+from helpers import get_current_audio_player_instance, bump_votes_version
+from crowdmixer import app, queue_jobs_cache
+from events import event_broadcaster
+from audioplayers import QueueError
+from models import Song
+from time import sleep
+import threading
+import queue
+import uuid
+
+__all__ = [
+    'QueueDispatcher',
+    'queue_dispatcher'
+]
+
+
+class QueueDispatcher:
+    """Queue songs in the audio player from a background thread, so HTTP requests don't have to wait for it.
+
+    Jobs statuses are stored in a dedicated cache, so they can be retrieved from any process and aren't evicted along
+    the rendered pages.
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    BATCH_SIZE = 20
+
+    def __init__(self):
+        self.jobs = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def dispatch(self, song, last_queued_at):
+        """Schedule the queuing of the given song. ``last_queued_at`` is restored if it cannot be queued. Returns the
+        job ID, or raises ``queue.Full`` if there's too many pending jobs."""
+        self._start()
+
+        job = {
+            'id': uuid.uuid4().hex,
+            'song_id': song.id,
+            'path': song.path,
+            'title': song.title,
+            'artist': song.artist,
+            'last_queued_at': last_queued_at
+        }
+
+        self._set_status(job, self.PENDING)
+
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            queue_jobs_cache.delete(self._get_cache_key(job['id']))
+
+            raise
+
+        return job['id']
+
+    def get_status(self, job_id):
+        """Return the status of a job (a dict), or None if it is unknown."""
+        return queue_jobs_cache.get(self._get_cache_key(job_id))
+
+    def _start(self):
+        # The thread is started lazily as it wouldn't survive the fork of the uWSGI workers
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+
+            if not self.jobs:
+                self.jobs = queue.Queue(maxsize=app.config['ASYNC_QUEUE_MAX_SIZE'])
+
+            self.thread = threading.Thread(target=self._run, name='queue-dispatcher', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            jobs = [self.jobs.get()]
+
+            # Songs submitted in a burst are sent to the audio player all at once
+            while len(jobs) < self.BATCH_SIZE:
+                try:
+                    jobs.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with app.app_context():
+                    self._process(jobs)
+            except Exception as e:
+                app.logger.exception(e)
+            finally:
+                for job in jobs:
+                    self.jobs.task_done()
+
+    def _process(self, jobs):
+        retries = app.config['ASYNC_QUEUE_RETRIES']
+
+        for attempt in range(retries + 1):
+            try:
+                get_current_audio_player_instance().queue_many([job['path'] for job in jobs])
+
+                failed = []
+            except QueueError as e:
+                error = e
+                failed = e.failed
+            except Exception as e:
+                error = e
+                failed = range(len(jobs))
+
+            # Only the songs that certainly haven't been queued are sent again, so none is duplicated in the playlist
+            for i, job in enumerate(jobs):
+                if i not in failed:
+                    self._set_status(job, self.DONE)
+
+            jobs = [jobs[i] for i in failed]
+
+            if not jobs:
+                return
+
+            if attempt < retries:
+                sleep(app.config['ASYNC_QUEUE_RETRY_DELAY'] * 2 ** attempt)
+
+        for job in jobs:
+            app.logger.warning('Unable to queue {}: {}'.format(job['path'], error))
+
+            self._set_status(job, self.FAILED, str(error))
+
+            try:
+                Song.query.cancel_queued(
+                    job['song_id'],
+                    app.config['VOTES_THRESHOLD'] - 1 if app.config['MODE'] == 'Vote' else 0,
+                    job['last_queued_at']
+                )
+
+                bump_votes_version()
+
+                if app.config['LIVE_UPDATES']:
+                    event_broadcaster.publish_song(job['song_id'])
+            except Exception as e:
+                app.logger.exception(e)
+
+    def _set_status(self, job, status, error=None):
+        queue_jobs_cache.set(self._get_cache_key(job['id']), {
+            'status': status,
+            'title': job['title'],
+            'artist': job['artist'],
+            'error': error
+        }, timeout=3600)
+
+    def _get_cache_key(self, job_id):
+        return 'queue_job_' + job_id
+
+
+queue_dispatcher = QueueDispatcher()
@@ -0,0 +1,150 @@
+from helpers import get_current_audio_player_class, get_current_audio_player_instance, get_now_playing_song, is_now_playing_pushed
+from crowdmixer import app, db
+from models import Song
+from time import sleep
+import threading
+import arrow
+import queue
+import json
+
+__all__ = [
+    'EventBroadcaster',
+    'event_broadcaster'
+]
+
+
+class EventBroadcaster:
+    """Broadcast live updates (currently playing song, votes and queue state of songs) to the clients connected to the
+    Server-Sent Events endpoint of the current process.
+
+    Every event is serialized once, then put in the queue of each subscriber. Subscribers too slow to consume their
+    queue miss events rather than slowing down everyone.
+    """
+    SUBSCRIBER_QUEUE_SIZE = 50
+    NOW_PLAYING_POLL_INTERVAL = 5
+    HEARTBEAT_INTERVAL = 15
+    CLIENT_RETRY_DELAY = 5
+
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.now_playing_message = None
+        self.now_playing_started = False
+
+    def subscribe(self):
+        """Return a new subscriber queue receiving the SSE-formatted messages, or None if there's already too many
+        subscribers."""
+        subscriber = queue.Queue(maxsize=self.SUBSCRIBER_QUEUE_SIZE)
+
+        with self.lock:
+            if len(self.subscribers) >= app.config['LIVE_UPDATES_MAX_CLIENTS']:
+                return None
+
+            self.subscribers.add(subscriber)
+
+            if self.now_playing_message:
+                subscriber.put_nowait(self.now_playing_message)
+
+        self._start_now_playing()
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, event, data):
+        message = 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data, separators=(',', ':')))
+
+        with self.lock:
+            if event == 'now_playing':
+                if message == self.now_playing_message:
+                    return message
+
+                self.now_playing_message = message
+
+            for subscriber in self.subscribers:
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    pass
+
+        return message
+
+    def publish_song(self, song_id):
+        """Publish the current votes count and queue state of a song."""
+        song = db.session.query(Song.votes, Song.last_queued_at).filter(Song.id == song_id).first()
+
+        if not song:
+            return
+
+        votes, last_queued_at = song
+
+        self.publish('song', {
+            'id': song_id,
+            'votes': votes,
+            'queued': last_queued_at is not None and (arrow.now().timestamp - last_queued_at.timestamp) <= app.config['BLOCK_TIME']
+        })
+
+    def _start_now_playing(self):
+        """Start following the currently playing song: audio players pushing it call us back, others are polled."""
+        if not app.config['SHOW_CURRENT_PLAYING']:
+            return
+
+        with self.lock:
+            if self.now_playing_started:
+                return
+
+            self.now_playing_started = True
+
+        try:
+            if not get_current_audio_player_class().is_now_playing_supported():
+                return
+
+            if is_now_playing_pushed():
+                audio_player = get_current_audio_player_instance()
+                audio_player.listen()
+                audio_player.add_now_playing_listener(lambda now_playing: self.publish('now_playing', now_playing))
+
+                # The listener is only called on changes: publish what's currently playing as well
+                threading.Thread(target=self._publish_now_playing, args=(audio_player, ), name='now-playing-publisher', daemon=True).start()
+            else:
+                threading.Thread(target=self._poll_now_playing, name='now-playing-poller', daemon=True).start()
+        except Exception as e:
+            app.logger.error(e)
+
+            # Try again on the next subscription
+            with self.lock:
+                self.now_playing_started = False
+
+    def _publish_now_playing(self, audio_player):
+        try:
+            self.publish('now_playing', audio_player.get_now_playing())
+        except Exception as e:
+            app.logger.error(e)
+
+    def _poll_now_playing(self):
+        now_playing = None
+        first = True
+
+        while True:
+            with self.lock:
+                has_subscribers = len(self.subscribers) > 0
+
+            if has_subscribers: # Don't bother the audio player if nobody is listening
+                try:
+                    with app.app_context():
+                        new_now_playing = get_now_playing_song()
+
+                    if first or new_now_playing != now_playing:
+                        now_playing = new_now_playing
+                        first = False
+
+                        self.publish('now_playing', now_playing)
+                except Exception as e:
+                    app.logger.error(e)
+
+            sleep(self.NOW_PLAYING_POLL_INTERVAL)
+
+
+event_broadcaster = EventBroadcaster()
@@ -1,12 +1,39 @@
-from crowdmixer import app, cache
+from crowdmixer import app, cache, versions_cache
+from models import Song
+from urllib.parse import urlencode
+from collections import namedtuple
+from flask_babel import _
+from werkzeug.exceptions import NotFound
+from flask import safe_join
+from time import time, sleep
 import audioplayers
+import threading
+import hashlib
+import uuid
+import os
 
 __all__ = [
+    'are_assets_built',
+    'bump_data_version',
+    'bump_votes_version',
     'chunks',
+    'count_songs',
+    'get_data_version',
     'get_current_audio_player_class',
+    'get_current_audio_player_config',
     'get_current_audio_player_instance',
     'get_now_playing_song',
-    'parse_duration'
+    'get_songs_rows',
+    'get_static_file_mtime',
+    'get_static_file_hash',
+    'get_songs_list_args',
+    'get_songs_list_cache_key',
+    'get_votes_version',
+    'is_now_playing_pushed',
+    'is_static_file',
+    'parse_duration',
+    'SongRow',
+    'walk_audio_files'
 ]
 
 
@@ -15,6 +42,87 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+def get_data_version():
+    """Return the current version of the songs library, which changes every time the songs are indexed."""
+    return _get_version('data_version')
+
+
+def bump_data_version():
+    """Change the version of the songs library, invalidating everything cached about it."""
+    return _bump_version('data_version')
+
+
+def get_votes_version():
+    """Return the current version of the votes and queue state of the songs, which changes every time a song is voted
+    for or queued."""
+    return _get_version('votes_version')
+
+
+def bump_votes_version():
+    """Change the version of the votes and queue state of the songs, invalidating the cached songs lists."""
+    return _bump_version('votes_version')
+
+
+def _get_version(name):
+    version = versions_cache.get(name)
+
+    if version is None:
+        version = _bump_version(name)
+
+    return version
+
+
+def _bump_version(name):
+    version = int(time() * 1000) # Never go back to a previous version, even if the cache has been cleared
+
+    versions_cache.set(name, version, timeout=0)
+
+    return version
+
+
+def get_songs_list_args(search_term, where, args, keyset):
+    """Return the request arguments (search, cursor or page) a songs list depends on, normalized and without the
+    unknown ones."""
+    songs_list_args = {
+        'q': search_term,
+        'w': where if search_term else None
+    }
+
+    if keyset:
+        songs_list_args['c'] = args.get('c') or None
+    else:
+        page = args.get('p', default=1, type=int)
+
+        songs_list_args['p'] = page if page != 1 else None
+
+    return {name: value for name, value in songs_list_args.items() if value is not None}
+
+
+def get_songs_list_cache_key(songs_list_args, locale):
+    """Return the key under which the rendered songs list for the given arguments (see ``get_songs_list_args``) is
+    cached. It changes with the songs library and the votes."""
+    return 'songs_list_{}_{}_{}_{}_{}'.format(
+        app.config['MODE'],
+        locale,
+        get_data_version(),
+        get_votes_version(),
+        urlencode(sorted(songs_list_args.items()))
+    )
+
+
+def count_songs(search_term=None, where='a', exact=False):
+    """Count (possibly from the cache) the songs matching a search. Returns the count and whether it is an estimation.
+
+    Counting stops at SONGS_COUNT_CAP songs unless ``exact`` is True.
+    """
+    return _count_songs(search_term, where, None if exact else app.config['SONGS_COUNT_CAP'], get_data_version())
+
+
+@cache.memoize(timeout=app.config['SONGS_COUNT_CACHE_TIME'])
+def _count_songs(search_term, where, cap, data_version):
+    return Song.query.count_search(search_term, where, cap)
+
+
 def get_current_audio_player_class():
     name = app.config['PLAYER_TO_USE']
 
@@ -24,25 +132,244 @@ def get_current_audio_player_class():
     return getattr(audioplayers, name)
 
 
-def get_current_audio_player_instance():
-    name = app.config['PLAYER_TO_USE']
+def get_current_audio_player_config():
+    return app.config['PLAYERS'].get(app.config['PLAYER_TO_USE'], {})
 
-    if name not in audioplayers.__all__:
-        raise ValueError('{} isn\'t a valid audio player name'.format(name))
 
-    config = {}
+def get_current_audio_player_instance():
+    return get_current_audio_player_class()(get_current_audio_player_config())
 
-    if name in app.config['PLAYERS']:
-        config = app.config['PLAYERS'][name]
 
-    return getattr(audioplayers, name)(config)
+def is_now_playing_pushed():
+    """Whether the current audio player pushes the currently playing song, without instantiating it."""
+    return get_current_audio_player_class().is_now_playing_pushed(get_current_audio_player_config())
 
 
-@cache.cached(timeout=app.config['NOW_PLAYING_CACHE_TIME'], key_prefix='now_playing_song')
 def get_now_playing_song():
-    audio_player = get_current_audio_player_instance()
+    # Audio players pushing the currently playing song already keep it in memory
+    if is_now_playing_pushed():
+        return get_current_audio_player_instance().get_now_playing()
+
+    return _get_now_playing_song()
+
+
+NOW_PLAYING_CACHE_KEY = 'now_playing_song'
+NOW_PLAYING_REFRESH_LOCK_FILE = 'storage/now_playing_refresh.lock' # Not in the cache directory, which is pruned
+NOW_PLAYING_REFRESH_LOCK_TIMEOUT = 30
+NOW_PLAYING_REFRESH_WAIT = 5
+NOW_PLAYING_REFRESH_POLL_INTERVAL = 0.1
+
+_now_playing = None # In-process copy of the cached {'song': ..., 'fetched_at': ...}
+_now_playing_lock = threading.Lock()
+
+
+def _get_now_playing_song():
+    """Return the currently playing song from a two-tier cache: in-process first, then the shared cache.
+
+    Once outdated (after NOW_PLAYING_CACHE_TIME seconds), it is still returned during NOW_PLAYING_STALE_TIME seconds
+    while being refreshed in the background. The audio player is only requested by one thread of one process at a time.
+    """
+    global _now_playing
+
+    now_playing = _now_playing
+
+    if not _is_now_playing_fresh(now_playing):
+        shared_now_playing = cache.get(NOW_PLAYING_CACHE_KEY)
+
+        if shared_now_playing and (not now_playing or shared_now_playing['fetched_at'] > now_playing['fetched_at']):
+            now_playing = _now_playing = shared_now_playing
+
+    if _is_now_playing_fresh(now_playing):
+        return now_playing['song']
+
+    if _is_now_playing_stale(now_playing): # Outdated: serve it while it is refreshed
+        if _now_playing_lock.acquire(blocking=False):
+            threading.Thread(target=_refresh_now_playing_song_in_background, name='now-playing-refresh', daemon=True).start()
+
+        return now_playing['song']
+
+    with _now_playing_lock:
+        if _is_now_playing_fresh(_now_playing): # Refreshed by another thread in the meantime
+            return _now_playing['song']
+
+        now_playing = _refresh_now_playing_song()
+
+        # Another process is refreshing it: wait for its result instead of telling that nothing is playing
+        deadline = time() + NOW_PLAYING_REFRESH_WAIT
+
+        while now_playing is None and time() < deadline:
+            sleep(NOW_PLAYING_REFRESH_POLL_INTERVAL)
+
+            shared_now_playing = cache.get(NOW_PLAYING_CACHE_KEY)
+
+            if _is_now_playing_stale(shared_now_playing):
+                now_playing = _now_playing = shared_now_playing
+            else: # Not refreshed yet, or the other process gave up: try to do it ourselves
+                now_playing = _refresh_now_playing_song()
+
+    return now_playing['song'] if now_playing else None # None if another process took too long to refresh it
+
+
+def _is_now_playing_fresh(now_playing):
+    return now_playing is not None and time() - now_playing['fetched_at'] < app.config['NOW_PLAYING_CACHE_TIME']
+
+
+def _is_now_playing_stale(now_playing):
+    """Whether the currently playing song is outdated but can still be served. Older than that, it is ignored."""
+    return now_playing is not None and time() - now_playing['fetched_at'] < app.config['NOW_PLAYING_CACHE_TIME'] + app.config['NOW_PLAYING_STALE_TIME']
+
 
-    return audio_player.get_now_playing()
+def _acquire_now_playing_refresh_lock():
+    """Take the lock preventing several processes from refreshing the currently playing song at the same time. Returns
+    its token, or None if another process holds it.
+
+    The lock is a file created only if it doesn't exist yet. One older than NOW_PLAYING_REFRESH_LOCK_TIMEOUT (e.g. left
+    by a killed process) is considered free."""
+    token = uuid.uuid4().hex
+
+    for attempt in range(2):
+        try:
+            fd = os.open(NOW_PLAYING_REFRESH_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time() - os.path.getmtime(NOW_PLAYING_REFRESH_LOCK_FILE) < NOW_PLAYING_REFRESH_LOCK_TIMEOUT:
+                    return None
+
+                os.remove(NOW_PLAYING_REFRESH_LOCK_FILE)
+            except FileNotFoundError: # Released in the meantime
+                pass
+
+            continue
+
+        try:
+            os.write(fd, token.encode())
+        finally:
+            os.close(fd)
+
+        return token
+
+    return None # Taken by another process in the meantime
+
+
+def _release_now_playing_refresh_lock(token):
+    try:
+        with open(NOW_PLAYING_REFRESH_LOCK_FILE) as f:
+            if f.read() != token: # Don't release it if it has been taken over in the meantime
+                return
+
+        os.remove(NOW_PLAYING_REFRESH_LOCK_FILE)
+    except FileNotFoundError:
+        pass
+
+
+def _refresh_now_playing_song():
+    """Get the currently playing song from the audio player and cache it. Returns None without doing anything if
+    another process is already doing it. Must be called with ``_now_playing_lock`` acquired."""
+    global _now_playing
+
+    token = _acquire_now_playing_refresh_lock()
+
+    if not token:
+        return None
+
+    try:
+        now_playing = {
+            'song': get_current_audio_player_instance().get_now_playing(),
+            'fetched_at': time()
+        }
+
+        cache.set(NOW_PLAYING_CACHE_KEY, now_playing, timeout=app.config['NOW_PLAYING_CACHE_TIME'] + app.config['NOW_PLAYING_STALE_TIME'])
+
+        _now_playing = now_playing
+
+        return now_playing
+    finally:
+        _release_now_playing_refresh_lock(token)
+
+
+def _refresh_now_playing_song_in_background():
+    try:
+        with app.app_context():
+            _refresh_now_playing_song()
+    except Exception as e:
+        app.logger.error(e)
+    finally:
+        _now_playing_lock.release()
+
+
+SongRow = namedtuple('SongRow', ['song', 'blocked', 'queued_label'])
+
+
+def get_songs_rows(songs, now, locale):
+    """Compute, in a single pass, the state of each song of a songs list: whether it has been queued too recently to
+    be submitted, and if so the label telling when."""
+    blocked_since = now.timestamp - app.config['BLOCK_TIME']
+    rows = []
+
+    for song in songs:
+        blocked = song.last_queued_at is not None and song.last_queued_at.timestamp >= blocked_since
+
+        rows.append(SongRow(
+            song=song,
+            blocked=blocked,
+            queued_label=_('Queued %(last_queued_at)s', last_queued_at=song.last_queued_at.humanize(now, locale=locale)) if blocked else None
+        ))
+
+    return rows
+
+
+_static_files_hashes = {} # Filename => (modification time, hash)
+
+
+def get_static_file_hash(filename):
+    """Return a short hash of the content of a static file (None if it doesn't exist), computed again only when the
+    file is modified."""
+    try:
+        path = safe_join(app.static_folder, filename)
+        mtime = os.path.getmtime(path)
+    except (NotFound, OSError):
+        return None
+
+    cached = _static_files_hashes.get(filename)
+
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, 'rb') as f:
+        file_hash = hashlib.md5(f.read()).hexdigest()[:12]
+
+    _static_files_hashes[filename] = (mtime, file_hash)
+
+    return file_hash
+
+
+BUILT_ASSETS = [
+    'vendor/font-awesome/css/font-awesome.min.css',
+    'vendor/knacss/knacss.min.css',
+    'css/app.min.css'
+]
+
+
+def get_static_file_mtime(filename):
+    """Return the modification time of a static file, or None if it doesn't exist."""
+    try:
+        path = safe_join(app.static_folder, filename)
+
+        return os.path.getmtime(path) if os.path.isfile(path) else None
+    except (NotFound, OSError):
+        return None
+
+
+def is_static_file(filename):
+    try:
+        return os.path.isfile(safe_join(app.static_folder, filename))
+    except NotFound:
+        return False
+
+
+def are_assets_built():
+    """Whether the front-end assets have been vendored by the build_assets command."""
+    return all(is_static_file(filename) for filename in BUILT_ASSETS)
 
 
 def parse_duration(duration):
@@ -54,6 +381,46 @@ def parse_duration(duration):
     if len(duration) == 1:
         return int(duration[0]) * 60 # Minutes
     elif len(duration) == 2:
-        return (int(duration[0]) * 60) + duration[1] # Minutes + seconds
+        return (int(duration[0]) * 60) + int(duration[1]) # Minutes + seconds
     else:
         return None
+
+
+def walk_audio_files(directory, extensions, unreadable_dirs=None):
+    """Lazily yield the path of every file under directory having one of the given extensions (case-insensitive).
+
+    The whole tree is walked only once, whatever the number of extensions. Hidden files and directories (e.g. macOS
+    ``._*`` resource forks or ``.Trash-*`` directories) are skipped. The directories that couldn't be read are
+    appended to ``unreadable_dirs``, if given.
+    """
+    extensions = tuple('.' + extension.lower() for extension in extensions)
+    directories = [directory]
+
+    while directories:
+        current_directory = directories.pop()
+
+        try:
+            entries = os.scandir(current_directory)
+        except OSError as e:
+            app.logger.warning(e)
+
+            if unreadable_dirs is not None:
+                unreadable_dirs.append(current_directory)
+
+            continue
+
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+
+                try:
+                    if entry.is_dir():
+                        directories.append(entry.path)
+                    elif entry.name.lower().endswith(extensions):
+                        yield entry.path
+                except OSError as e:
+                    app.logger.warning(e)
+
+                    if unreadable_dirs is not None:
+                        unreadable_dirs.append(entry.path)
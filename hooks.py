@@ -1,6 +1,7 @@
 from flask import render_template, make_response, g, request
 from werkzeug.exceptions import HTTPException
 from crowdmixer import app, babel
+from helpers import get_current_audio_player_instance, get_static_file_hash, are_assets_built, is_now_playing_pushed
 
 
 @app.before_request
@@ -12,6 +13,43 @@ def set_locale():
             g.CURRENT_LOCALE = request.accept_languages.best_match(app.config['LANGUAGES'].keys(), default=app.config['DEFAULT_LANGUAGE'])
 
 
+@app.before_first_request
+def listen_now_playing():
+    if not app.config['SHOW_CURRENT_PLAYING']:
+        return
+
+    try:
+        if is_now_playing_pushed():
+            get_current_audio_player_instance().listen()
+    except Exception as e:
+        app.logger.error(e)
+
+
+@app.context_processor
+def inject_assets_built():
+    return {'assets_built': are_assets_built()}
+
+
+@app.url_defaults
+def add_static_file_hash(endpoint, values):
+    """Add the hash of static files to their URL, so they can be cached forever: their URL changes with them."""
+    if endpoint != 'static' or 'v' in values or 'filename' not in values:
+        return
+
+    file_hash = get_static_file_hash(values['filename'])
+
+    if file_hash:
+        values['v'] = file_hash
+
+
+@app.after_request
+def set_static_file_cache_control(response):
+    if request.endpoint == 'static' and response.status_code == 200 and request.args.get('v') and request.args.get('v') == get_static_file_hash(request.view_args['filename']):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+
+    return response
+
+
 @babel.localeselector
 def get_app_locale():
     if not hasattr(g, 'CURRENT_LOCALE'):
@@ -1,36 +1,401 @@
+from sqlalchemy.sql import table, column, text
+from flask_sqlalchemy import Pagination
+from flask import abort
 from sqlalchemy_utils import ArrowType
-from sqlalchemy import or_
+from sqlalchemy import or_, and_, event
 from crowdmixer import db, app
+import base64
+import arrow
+import json
+import re
 
 __all__ = [
-    'Song'
+    'SONGS_FTS_TABLE',
+    'KeysetPagination',
+    'Song',
+    'create_songs_fts',
+    'create_songs_fts_table',
+    'create_songs_fts_triggers',
+    'is_songs_fts_available',
+    'is_songs_fts_supported'
 ]
 
+SONGS_FTS_TABLE = 'songs_fts'
+
+# Statements keeping the full-text search index in sync with the songs table
+SONGS_FTS_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON songs BEGIN
+        INSERT INTO {fts} (rowid, title, artist, album) VALUES (new.id, new.title, new.artist, new.album);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON songs BEGIN
+        INSERT INTO {fts} ({fts}, rowid, title, artist, album) VALUES ('delete', old.id, old.title, old.artist, old.album);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF title, artist, album ON songs BEGIN
+        INSERT INTO {fts} ({fts}, rowid, title, artist, album) VALUES ('delete', old.id, old.title, old.artist, old.album);
+        INSERT INTO {fts} (rowid, title, artist, album) VALUES (new.id, new.title, new.artist, new.album);
+    END'''
+]
+
+_songs_fts_available = None
+
+
+def is_songs_fts_supported(execute):
+    """Whether the SQLite library has been compiled with FTS5."""
+    return any(option == 'ENABLE_FTS5' for option, in execute('PRAGMA compile_options').fetchall())
+
+
+def create_songs_fts(execute):
+    """Create (if needed) and fill the songs full-text search index and the triggers keeping it in sync.
+
+    ``execute`` is either a SQLAlchemy connection's or a DBAPI cursor's ``execute`` method.
+    """
+    create_songs_fts_table(execute)
+    create_songs_fts_triggers(execute)
+
+    execute('INSERT INTO {fts} ({fts}) VALUES (\'rebuild\')'.format(fts=SONGS_FTS_TABLE))
+
+
+def create_songs_fts_table(execute, name=SONGS_FTS_TABLE):
+    """Create (if needed) an empty songs full-text search index. Its content is always read from the songs table."""
+    execute('''CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+        title, artist, album,
+        content='songs', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 1'
+    )'''.format(fts=name))
+
+
+def create_songs_fts_triggers(execute):
+    """Create (if needed) the triggers keeping the songs full-text search index in sync with the songs table."""
+    for trigger in SONGS_FTS_TRIGGERS:
+        execute(trigger.format(fts=SONGS_FTS_TABLE))
+
+
+def is_songs_fts_available():
+    """Whether the songs full-text search index exists. The result is kept for the lifetime of the process."""
+    global _songs_fts_available
+
+    if _songs_fts_available is None:
+        _songs_fts_available = db.session.execute(
+            text('SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = :name'),
+            {'name': SONGS_FTS_TABLE}
+        ).scalar() is not None
+
+    return _songs_fts_available
+
+
+class KeysetPagination:
+    """A page of songs returned by ``Song.SongQuery.search_keyset_paginated``.
+
+    Previous and next pages are identified by opaque cursors, which encode the sort key of the first or last song of
+    this page.
+    """
+    def __init__(self, items, keys, has_prev, has_next):
+        self.items = items
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_cursor = self.encode_cursor(True, keys[0]) if has_prev and keys else None
+        self.next_cursor = self.encode_cursor(False, keys[-1]) if has_next and keys else None
+
+    @staticmethod
+    def encode_cursor(backwards, values):
+        return base64.urlsafe_b64encode(json.dumps([backwards] + values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            decoded = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+        except Exception as e:
+            raise ValueError('Invalid cursor') from e
+
+        if not isinstance(decoded, list) or not decoded or not isinstance(decoded[0], bool):
+            raise ValueError('Invalid cursor')
+
+        # Key values end up bound to SQL parameters
+        if not all(value is None or isinstance(value, (str, int, float)) for value in decoded[1:]):
+            raise ValueError('Invalid cursor')
+
+        return decoded[0], decoded[1:]
+
 
 class Song(db.Model):
     class SongQuery(db.Query):
-        def search_paginated(self, search_term=None, where='a', order_by_votes=False, page=1):
-            q = self
+        fts_columns = {
+            'ar': 'artist',
+            'al': 'album',
+            't': 'title'
+        }
+
+        def search(self, search_term=None, where='a', order_by_votes=False):
+            q, rank = self._filter_search(search_term, where)
 
             if order_by_votes:
                 q = q.order_by(Song.votes.desc())
 
+            if rank is not None:
+                q = q.order_by(rank)
+
             q = q.order_by(Song.title.asc())
             q = q.order_by(Song.artist.asc())
 
-            if search_term:
-                if where == 'ar':
-                    fil = Song.artist.like('%' + search_term + '%')
-                elif where == 'al':
-                    fil = Song.album.like('%' + search_term + '%')
-                elif where == 't':
-                    fil = Song.title.like('%' + search_term + '%')
-                elif where == 'a':
-                    fil = or_(Song.artist.like('%' + search_term + '%'), Song.album.like('%' + search_term + '%'), Song.title.like('%' + search_term + '%'))
+            return q
+
+        def search_paginated(self, search_term=None, where='a', order_by_votes=False, page=1, total=None):
+            """Paginate search results using page numbers. Pass ``total`` if the results count is already known to
+            avoid counting them again."""
+            q = self.search(search_term, where, order_by_votes)
+            per_page = app.config['SONGS_PER_PAGE']
+
+            if total is None:
+                return q.paginate(page=page, per_page=per_page)
+
+            if page < 1:
+                abort(404)
+
+            items = q.limit(per_page).offset((page - 1) * per_page).all()
+
+            if not items and page != 1:
+                abort(404)
+
+            return Pagination(q, page, per_page, total, items)
+
+        def count_search(self, search_term=None, where='a', cap=None):
+            """Count search results. Counting stops after ``cap`` results if given: returns the count and whether it has
+            been capped."""
+            q, rank = self._filter_search(search_term, where)
+
+            if cap is not None:
+                q = q.limit(cap + 1)
+
+            total = q.count()
+
+            if cap is not None and total > cap:
+                return cap, True
+
+            return total, False
+
+        def search_keyset(self, search_term=None, where='a', order_by_votes=False, cursor=None):
+            """Search songs located after (or before) the sort key encoded in the given cursor, ordered accordingly.
+
+            Returns the query, the sort key columns, whether the query is going backwards and whether a valid cursor
+            has been given. When searching using the full-text search index, the query returns (song, rank) rows.
+            """
+            q, rank = self._filter_search(search_term, where)
+
+            keys = [(Song.title, False), (Song.artist, False), (Song.id, False)]
+
+            # Same ordering as search(): the relevance rank is selected along every song, as it isn't one of its columns
+            if rank is not None:
+                rank = rank.label('rank')
+
+                q = q.add_columns(rank)
+
+                keys.insert(0, (rank, False))
+
+            if order_by_votes:
+                keys.insert(0, (Song.votes, True))
+
+            try:
+                backwards, values = KeysetPagination.decode_cursor(cursor) if cursor else (False, None)
+            except ValueError:
+                backwards, values = False, None
+
+            if values is not None and len(values) == len(keys):
+                q = q.filter(self._get_seek_filter(keys, values, backwards))
+            else:
+                backwards, values = False, None
 
-                q = q.filter(fil)
+            for key_column, descending in keys:
+                q = q.order_by(key_column.desc() if descending != backwards else key_column.asc())
 
-            return q.paginate(page=page, per_page=app.config['SONGS_PER_PAGE'])
+            return q, [key_column for key_column, descending in keys], backwards, values is not None
+
+        def search_keyset_paginated(self, search_term=None, where='a', order_by_votes=False, cursor=None):
+            """Paginate search results by seeking after (or before) the sort key of the last (or first) song of the
+            current page, so that every page costs the same whatever its position.
+
+            Results are ordered like ``search`` does, including by relevance.
+            """
+            q, keys, backwards, has_cursor = self.search_keyset(search_term, where, order_by_votes, cursor)
+
+            per_page = app.config['SONGS_PER_PAGE']
+
+            rows = q.limit(per_page + 1).all()
+            has_more = len(rows) > per_page
+            rows = rows[:per_page]
+
+            if backwards:
+                rows.reverse()
+
+                has_prev, has_next = has_more, True
+            else:
+                has_prev, has_next = has_cursor, has_more
+
+            rows = [(row, None) if isinstance(row, Song) else tuple(row) for row in rows] # (song, rank)
+
+            return KeysetPagination(
+                [song for song, rank in rows],
+                [[rank if key_column.key == 'rank' else getattr(song, key_column.key) for key_column in keys] for song, rank in rows],
+                has_prev,
+                has_next
+            )
+
+        def vote(self, song_id, threshold, block_time):
+            """Atomically add a vote for a song, then reset its votes and mark it as queued if the threshold is reached.
+
+            Returns None if the song has been queued less than ``block_time`` seconds ago (or doesn't exist). Otherwise,
+            returns the votes count and whether the song must now be queued by the caller.
+            """
+            try:
+                voted = self.filter(Song.id == song_id, self._not_blocked(block_time)).update(
+                    {Song.votes: Song.votes + 1},
+                    synchronize_session=False
+                )
+
+                if not voted:
+                    db.session.rollback()
+
+                    return None
+
+                # The write lock is held since the previous statement, so no concurrent vote can sneak in here
+                queue = self.filter(Song.id == song_id, Song.votes >= threshold).update(
+                    {
+                        Song.votes: 0,
+                        Song.total_times_queued: Song.total_times_queued + 1,
+                        Song.last_queued_at: arrow.utcnow()
+                    },
+                    synchronize_session=False
+                ) > 0
+
+                votes = db.session.query(Song.votes).filter(Song.id == song_id).scalar()
+
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+
+                raise
+
+            return votes, queue
+
+        def mark_queued(self, song_id, block_time):
+            """Atomically mark a song as queued. Returns False if it has been queued less than ``block_time`` seconds ago
+            (or doesn't exist)."""
+            try:
+                queued = self.filter(Song.id == song_id, self._not_blocked(block_time)).update(
+                    {
+                        Song.votes: 0,
+                        Song.total_times_queued: Song.total_times_queued + 1,
+                        Song.last_queued_at: arrow.utcnow()
+                    },
+                    synchronize_session=False
+                ) > 0
+
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+
+                raise
+
+            return queued
+
+        def cancel_queued(self, song_id, votes, last_queued_at):
+            """Revert what ``vote`` or ``mark_queued`` did when the song couldn't actually be queued. ``votes`` are added
+            back to the ones casted since, and ``last_queued_at`` is restored."""
+            try:
+                self.filter(Song.id == song_id).update(
+                    {
+                        Song.votes: Song.votes + votes,
+                        Song.total_times_queued: Song.total_times_queued - 1,
+                        Song.last_queued_at: last_queued_at
+                    },
+                    synchronize_session=False
+                )
+
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+
+                raise
+
+        def _not_blocked(self, block_time):
+            return or_(Song.last_queued_at.is_(None), Song.last_queued_at < arrow.utcnow().shift(seconds=-block_time))
+
+        def _filter_search(self, search_term, where):
+            """Filter on the search term. Returns the query and the relevance rank column (if any)."""
+            if not search_term:
+                return self, None
+
+            fts_match = self._get_fts_match(search_term, where) if is_songs_fts_available() else None
+
+            if fts_match:
+                fts = table(SONGS_FTS_TABLE, column('rowid'), column('rank'))
+
+                return self.join(fts, fts.c.rowid == Song.id).filter(text('{} MATCH :fts_match'.format(SONGS_FTS_TABLE)).bindparams(fts_match=fts_match)), fts.c.rank
+            else:
+                return self.filter(self._get_like_filter(search_term, where)), None
+
+        def _get_seek_filter(self, keys, values, backwards):
+            """Build the condition matching the rows located after (or before) the given sort key values.
+
+            SQLite sorts NULLs first in ascending order, which is taken into account here.
+            """
+            conditions = []
+            equals = []
+
+            for (key_column, descending), value in zip(keys, values):
+                if descending != backwards:
+                    if value is None:
+                        after = None
+                    else:
+                        after = or_(key_column < value, key_column.is_(None))
+                else:
+                    after = key_column.isnot(None) if value is None else key_column > value
+
+                if after is not None:
+                    conditions.append(and_(*(equals + [after])))
+
+                equals.append(key_column.is_(None) if value is None else key_column == value)
+
+            # Redundant bound on the leading sort key column so SQLite seeks in the index instead of scanning it
+            (key_column, descending), value = keys[0], values[0]
+
+            if descending != backwards:
+                if value is None:
+                    bound = key_column.is_(None)
+                elif not getattr(key_column, 'nullable', True):
+                    bound = key_column <= value
+                else:
+                    bound = None
+            else:
+                bound = key_column >= value if value is not None else None
+
+            if bound is not None:
+                return and_(bound, or_(*conditions))
+
+            return or_(*conditions)
+
+        def _get_fts_match(self, search_term, where):
+            """Build a FTS5 query prefix-matching every word of the search term."""
+            words = re.findall(r'\w+', search_term)
+
+            if not words:
+                return None
+
+            if where in self.fts_columns:
+                column_filter = self.fts_columns[where] + ' : '
+            else:
+                column_filter = ''
+
+            return ' '.join('{}"{}"*'.format(column_filter, word) for word in words)
+
+        def _get_like_filter(self, search_term, where):
+            if where == 'ar':
+                return Song.artist.like('%' + search_term + '%')
+            elif where == 'al':
+                return Song.album.like('%' + search_term + '%')
+            elif where == 't':
+                return Song.title.like('%' + search_term + '%')
+            else:
+                return or_(Song.artist.like('%' + search_term + '%'), Song.album.like('%' + search_term + '%'), Song.title.like('%' + search_term + '%'))
 
     __tablename__ = 'songs'
     query_class = SongQuery
@@ -43,7 +408,27 @@ class Song(db.Model):
     path = db.Column(db.String, nullable=False)
     last_queued_at = db.Column(ArrowType, default=None)
     total_times_queued = db.Column(db.Integer, default=0)
-    votes = db.Column(db.Integer, default=0)
+    votes = db.Column(db.Integer, nullable=False, default=0)
+    size = db.Column(db.Integer, default=None)
+    mtime = db.Column(db.Float, default=None)
 
     def __repr__(self):
         return '<Song> #{} : {}'.format(self.id, self.title)
+
+
+# Match the songs list orderings (see Song.SongQuery.search_keyset_paginated) so SQLite doesn't have to sort the whole
+# table on every page
+db.Index('ix_songs_votes_title_artist_id', Song.votes.desc(), Song.title, Song.artist, Song.id)
+db.Index('ix_songs_title_artist_id', Song.title, Song.artist, Song.id)
+db.Index('ux_songs_path', Song.path, unique=True)
+
+
+@event.listens_for(Song.__table__, 'after_create')
+def songs_after_create(target, connection, **kwargs):
+    if is_songs_fts_supported(connection.execute):
+        create_songs_fts(connection.execute)
+
+
+@event.listens_for(Song.__table__, 'before_drop')
+def songs_before_drop(target, connection, **kwargs):
+    connection.execute('DROP TABLE IF EXISTS {}'.format(SONGS_FTS_TABLE))
@@ -1,9 +1,17 @@
-from flask import render_template, g, request, flash, redirect, url_for, session
+from flask import render_template, g, request, flash, redirect, url_for, session, abort, Response, jsonify, make_response, send_from_directory
 from flask_babel import _
-from crowdmixer import app
+from crowdmixer import app, db, cache
 from helpers import *
 from models import *
 from forms import *
+from dispatcher import *
+from events import *
+import mimetypes
+import hashlib
+import arrow
+import json
+import queue
+import os
 
 
 @app.route('/')
@@ -17,15 +25,10 @@ def home():
         search_term = search_form.q.data
         where = search_form.w.data
 
-    songs_paginated = Song.query.search_paginated(
-        search_term=search_term,
-        where=where,
-        order_by_votes=app.config['MODE'] == 'Vote',
-        page=request.args.get('p', default=1, type=int)
-    )
+    now = arrow.now()
 
     now_playing = None
-    already_submitted_time = None
+    submit_limited = False
 
     if app.config['SHOW_CURRENT_PLAYING'] and get_current_audio_player_class().is_now_playing_supported():
         try:
@@ -36,33 +39,295 @@ def home():
     if 'already_submitted_time' in session and session['already_submitted_time']:
         already_submitted_time = arrow.get(session['already_submitted_time'])
 
-    return render_template('home.html', songs_paginated=songs_paginated, now_playing=now_playing, already_submitted_time=already_submitted_time, search_form=search_form)
+        submit_limited = (now.timestamp - already_submitted_time.timestamp) <= app.config['REQUEST_LIMIT']
+
+    if session.get('queue_jobs'):
+        flash_queue_jobs_statuses()
+
+    songs_list_args = get_songs_list_args(search_term, where, request.args, app.config['KEYSET_PAGINATION'])
+    songs_list_cache_key = get_songs_list_cache_key(songs_list_args, g.CURRENT_LOCALE)
+
+    # Pages displaying messages are never the same, and must not be served from the browser's cache
+    etag = None if '_flashes' in session else get_home_etag(songs_list_cache_key, now, now_playing, submit_limited)
+
+    if etag and request.if_none_match.contains_weak(etag):
+        return make_not_modified_response(etag, weak=True)
+
+    songs_count, songs_count_estimated = count_songs(search_term, where, exact=not app.config['KEYSET_PAGINATION']) # Exact count needed to compute the pages count
+
+    # The songs list is the same for everyone, until the songs library or the votes change
+    songs_list = cache.get(songs_list_cache_key) if app.config['SONGS_LIST_CACHE_TIME'] else None
+
+    if songs_list is None:
+        if app.config['KEYSET_PAGINATION']:
+            songs_paginated = Song.query.search_keyset_paginated(
+                search_term=search_term,
+                where=where,
+                order_by_votes=app.config['MODE'] == 'Vote',
+                cursor=songs_list_args.get('c')
+            )
+        else:
+            songs_paginated = Song.query.search_paginated(
+                search_term=search_term,
+                where=where,
+                order_by_votes=app.config['MODE'] == 'Vote',
+                page=songs_list_args.get('p', 1),
+                total=songs_count
+            )
+
+        songs_rows = get_songs_rows(songs_paginated.items, now, g.CURRENT_LOCALE)
+
+        songs_list = render_template('songs_list.html', songs_paginated=songs_paginated, songs_rows=songs_rows, songs_list_args=songs_list_args)
+
+        if app.config['SONGS_LIST_CACHE_TIME']:
+            cache.set(songs_list_cache_key, songs_list, timeout=app.config['SONGS_LIST_CACHE_TIME'])
+
+    response = make_response(render_template('home.html', songs_list=songs_list, songs_count=songs_count, songs_count_estimated=songs_count_estimated, now_playing=now_playing, submit_limited=submit_limited, search_form=search_form))
+
+    if etag:
+        response.set_etag(etag, weak=True)
+
+    # Browsers must check the page is still the same before using their copy
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+    return response
+
+
+@app.endpoint('static')
+def static(filename):
+    """Serve static files, using their precompressed version (see the build_assets command) if the browser accepts it."""
+    mtime = get_static_file_mtime(filename)
+    compressed_versions = []
+
+    if mtime is not None:
+        for encoding, extension in (('br', '.br'), ('gzip', '.gz')):
+            compressed_mtime = get_static_file_mtime(filename + extension)
+
+            # Ignored if the file has been modified since it was compressed, until build_assets is run again
+            if compressed_mtime is not None and compressed_mtime >= mtime:
+                compressed_versions.append((encoding, extension))
+
+    for encoding, extension in compressed_versions:
+        if request.accept_encodings[encoding]:
+            response = send_from_directory(
+                app.static_folder,
+                filename + extension,
+                mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                cache_timeout=app.get_send_file_max_age(filename)
+            )
+
+            response.headers['Content-Encoding'] = encoding
+
+            break
+    else:
+        response = app.send_static_file(filename)
+
+    if compressed_versions:
+        response.vary.add('Accept-Encoding')
+
+    return response
 
 
 @app.route('/submit/<song_id>')
 def submit(song_id):
+    outcome, song, messages = submit_song(song_id)
+
+    for category, message in messages:
+        flash(message, category)
+
+    return redirect(url_for('home', **request.args.to_dict()))
+
+
+@app.route('/api/songs')
+def api_songs():
+    """Search songs, paginated using cursors (``c`` parameter). Results are those of the home page, without the HTML."""
+    search_form = SearchForm(formdata=request.args, meta={'csrf': False})
+
+    search_term = search_form.q.default
+    where = search_form.w.default
+
+    if search_form.validate():
+        search_term = search_form.q.data
+        where = search_form.w.data
+
+    now = arrow.now()
+
+    songs_list_args = get_songs_list_args(search_term, where, request.args, True)
+
+    # Queue states depend on the current time as well: they may change every minute
+    etag = hashlib.md5('{}_{}'.format(get_songs_list_cache_key(songs_list_args, 'api'), int(now.timestamp / 60)).encode()).hexdigest()
+
+    if etag in request.if_none_match:
+        return make_not_modified_response(etag)
+
+    songs_count, songs_count_estimated = count_songs(search_term, where)
+
+    songs_paginated = Song.query.search_keyset_paginated(
+        search_term=search_term,
+        where=where,
+        order_by_votes=app.config['MODE'] == 'Vote',
+        cursor=songs_list_args.get('c')
+    )
+
+    response = jsonify({
+        'songs': [get_song_payload(row.song, row.blocked) for row in get_songs_rows(songs_paginated.items, now, g.CURRENT_LOCALE)],
+        'count': songs_count,
+        'count_estimated': songs_count_estimated,
+        'prev': songs_paginated.prev_cursor,
+        'next': songs_paginated.next_cursor
+    })
+
+    response.set_etag(etag)
+
+    return response
+
+
+@app.route('/api/songs/<int:song_id>/submit', methods=['POST'])
+def api_submit(song_id):
+    """Vote for or queue a song, in one round trip. The response tells what happened, as well as the new state of the
+    song."""
+    outcome, song, messages = submit_song(song_id)
+
+    payload = {
+        'outcome': outcome,
+        'messages': [{'category': category, 'message': message} for category, message in messages]
+    }
+
+    if song and outcome != SUBMIT_MISSING: # Missing songs have been deleted
+        payload['song'] = get_song_payload(song)
+
+    return jsonify(payload), SUBMIT_HTTP_STATUSES[outcome]
+
+
+@app.route('/api/now-playing')
+def api_now_playing():
+    if not app.config['SHOW_CURRENT_PLAYING'] or not get_current_audio_player_class().is_now_playing_supported():
+        return jsonify({'error': 'Not available'}), 404
+
+    try:
+        now_playing = get_now_playing_song()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 503
+
+    response = jsonify({'song': now_playing})
+
+    response.add_etag()
+
+    return response.make_conditional(request)
+
+
+@app.route('/events')
+def events():
+    """Server-Sent Events stream of the currently playing song and of the votes and queue state of songs."""
+    if not app.config['LIVE_UPDATES']:
+        abort(404)
+
+    subscriber = event_broadcaster.subscribe()
+
+    if not subscriber: # Also tells the browser not to reconnect
+        return Response(status=204)
+
+    def stream():
+        try:
+            yield 'retry: {}\n\n'.format(EventBroadcaster.CLIENT_RETRY_DELAY * 1000)
+
+            while True:
+                try:
+                    yield subscriber.get(timeout=EventBroadcaster.HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    yield ': heartbeat\n\n' # Prevents proxies from closing the connection
+        finally: # The client is gone
+            event_broadcaster.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+def flash_queue_jobs_statuses():
+    """Report the songs submitted by the current user that couldn't be queued in the background."""
+    pending_jobs = []
+
+    for job_id in session['queue_jobs']:
+        job = queue_dispatcher.get_status(job_id)
+
+        if not job:
+            continue
+
+        if job['status'] == QueueDispatcher.PENDING:
+            pending_jobs.append(job_id)
+        elif job['status'] == QueueDispatcher.FAILED:
+            if job['artist']:
+                from_artist = ' ' + _('from <strong>%(artist)s</strong>', artist=job['artist'])
+            else:
+                from_artist = ''
+
+            flash(_('<strong>%(title)s</strong>%(from_artist)s couldn\'t be queued: %(error)s', title=job['title'], from_artist=from_artist, error=job['error']), 'error')
+
+    session['queue_jobs'] = pending_jobs
+
+
+SUBMIT_NOT_FOUND = 'not_found'
+SUBMIT_MISSING = 'missing'
+SUBMIT_BLOCKED = 'blocked'
+SUBMIT_LIMITED = 'limited'
+SUBMIT_VOTED = 'voted'
+SUBMIT_QUEUED = 'queued'
+SUBMIT_QUEUING = 'queuing'
+SUBMIT_FAILED = 'failed'
+
+SUBMIT_HTTP_STATUSES = {
+    SUBMIT_NOT_FOUND: 404,
+    SUBMIT_MISSING: 404,
+    SUBMIT_BLOCKED: 409,
+    SUBMIT_LIMITED: 429,
+    SUBMIT_VOTED: 200,
+    SUBMIT_QUEUED: 200,
+    SUBMIT_QUEUING: 202,
+    SUBMIT_FAILED: 503
+}
+
+
+def submit_song(song_id):
+    """Vote for or queue a song on behalf of the current user, according to the submit mode.
+
+    Returns the outcome (one of the ``SUBMIT_*`` constants), the song (None if it doesn't exist) and the messages to
+    show to the user, as (category, message) tuples.
+    """
     song = Song.query.get(song_id)
+    messages = []
+    outcome = SUBMIT_FAILED
 
     already_submitted_time = None
-    queue_song = False
-    update_db = False
 
     if 'already_submitted_time' in session and session['already_submitted_time']:
         already_submitted_time = arrow.get(session['already_submitted_time'])
 
     if not song:
-        flash(_('This song doesn\'t exist.'), 'error')
+        outcome = SUBMIT_NOT_FOUND
+
+        messages.append(('error', _('This song doesn\'t exist.')))
     elif not os.path.isfile(song.path):
-        flash(_('This song file doesn\'t seems to exist anymore. Please choose another one.'), 'error')
+        outcome = SUBMIT_MISSING
+
+        messages.append(('error', _('This song file doesn\'t seems to exist anymore. Please choose another one.')))
 
         try:
             db.session.delete(song)
             db.session.commit()
+
+            bump_data_version()
         except Exception as e:
-            flash(_('Error while deleting this song from the database: %(error)s', error=e), 'error')
+            messages.append(('error', _('Error while deleting this song from the database: %(error)s', error=e)))
     elif song.last_queued_at and (arrow.now().timestamp - song.last_queued_at.timestamp) <= app.config['BLOCK_TIME']:
-        flash(_('This song has already been queued %(last_queued_at)s. A song can be queued only one time every %(block_time)i minutes.', block_time=app.config['BLOCK_TIME'] / 60, last_queued_at=song.last_queued_at.humanize(locale=g.CURRENT_LOCALE)), 'error')
+        outcome = SUBMIT_BLOCKED
+
+        messages.append(('error', get_already_queued_message(song.last_queued_at)))
     elif already_submitted_time and (arrow.now().timestamp - already_submitted_time.timestamp) <= app.config['REQUEST_LIMIT']:
+        outcome = SUBMIT_LIMITED
+
         if app.config['MODE'] == 'Vote':
             action = _('voted for')
             cannot = _('vote more than one time')
@@ -70,55 +335,128 @@ def submit(song_id):
             action = _('queued')
             cannot = _('queue more than one')
 
-        flash(_('You already %(action)s a song %(already_submitted_time)s. You cannot %(cannot)s every %(request_limit)i minutes.', action=action, cannot=cannot, request_limit=app.config['REQUEST_LIMIT'] / 60, already_submitted_time=already_submitted_time.humanize(locale=g.CURRENT_LOCALE)), 'error')
+        messages.append(('error', _('You already %(action)s a song %(already_submitted_time)s. You cannot %(cannot)s every %(request_limit)i minutes.', action=action, cannot=cannot, request_limit=app.config['REQUEST_LIMIT'] / 60, already_submitted_time=already_submitted_time.humanize(locale=g.CURRENT_LOCALE))))
     else:
-        if app.config['MODE'] == 'Vote':
-            song.votes += 1
+        if song.artist:
+            from_artist = ' ' + _('from <strong>%(artist)s</strong>', artist=song.artist)
+        else:
+            from_artist = ''
 
-            if song.votes == app.config['VOTES_THRESHOLD']:
-                song.votes = 0
+        queue_song = False
+        updated = False # Whether the votes or the queue state of the song changed in the database
+        last_queued_at = song.last_queued_at # Song is expired after each commit
 
-                queue_song = True
-            else:
-                session['already_submitted_time'] = arrow.now().format()
+        # Votes and queue state are updated in the database in an atomic way, as concurrent submits may happen
+        try:
+            if app.config['MODE'] == 'Vote':
+                vote = Song.query.vote(song.id, app.config['VOTES_THRESHOLD'], app.config['BLOCK_TIME'])
 
-                if song.artist:
-                    from_artist = ' ' + _('from <strong>%(artist)s</strong>', artist=song.artist)
+                if not vote:
+                    outcome = SUBMIT_BLOCKED
+
+                    messages.append(('error', get_already_queued_message(arrow.now())))
                 else:
-                    from_artist = ''
+                    votes, queue_song = vote
+                    updated = True
 
-                flash(_('Your vote for <strong>%(title)s</strong>%(from_artist)s was successfuly saved! <strong>%(remaining_votes)i</strong> vote(s) is(are) remaining before this song is queued.', title=song.title, from_artist=from_artist, remaining_votes=app.config['VOTES_THRESHOLD'] - song.votes), 'success')
+                    if not queue_song:
+                        outcome = SUBMIT_VOTED
 
-            update_db = True
-        elif app.config['MODE'] == 'Immediate':
-            queue_song = True
+                        session['already_submitted_time'] = arrow.now().format()
+
+                        messages.append(('success', _('Your vote for <strong>%(title)s</strong>%(from_artist)s was successfuly saved! <strong>%(remaining_votes)i</strong> vote(s) is(are) remaining before this song is queued.', title=song.title, from_artist=from_artist, remaining_votes=app.config['VOTES_THRESHOLD'] - votes)))
+            elif app.config['MODE'] == 'Immediate':
+                queue_song = updated = Song.query.mark_queued(song.id, app.config['BLOCK_TIME'])
+
+                if not queue_song:
+                    outcome = SUBMIT_BLOCKED
+
+                    messages.append(('error', get_already_queued_message(arrow.now())))
+        except Exception as e:
+            messages.append(('error', _('Error while updating data related to this song: %(error)s', error=e)))
 
-        if queue_song:
-            song.total_times_queued += 1
-            song.last_queued_at = arrow.now()
+        if queue_song and app.config['ASYNC_QUEUE']:
+            try:
+                job_id = queue_dispatcher.dispatch(song, last_queued_at)
+
+                outcome = SUBMIT_QUEUING
+
+                session['queue_jobs'] = session.get('queue_jobs', []) + [job_id]
+                session['already_submitted_time'] = arrow.now().format()
 
+                messages.append(('success', _('<strong>%(title)s</strong>%(from_artist)s will be queued in a moment! It should be played shortly.', title=song.title, from_artist=from_artist)))
+            except queue.Full:
+                messages.append(('error', _('Too many songs are being queued right now. Please try again in a moment.')))
+
+                try:
+                    Song.query.cancel_queued(song.id, app.config['VOTES_THRESHOLD'] - 1 if app.config['MODE'] == 'Vote' else 0, last_queued_at)
+                except Exception as e:
+                    messages.append(('error', _('Error while updating data related to this song: %(error)s', error=e)))
+        elif queue_song:
             try:
                 audio_player = get_current_audio_player_instance()
                 audio_player.queue(song.path)
 
-                if song.artist:
-                    from_artist = ' ' + _('from <strong>%(artist)s</strong>', artist=song.artist)
-                else:
-                    from_artist = ''
+                outcome = SUBMIT_QUEUED
 
-                flash(_('<strong>%(title)s</strong>%(from_artist)s was successfully queued! It should be played shortly.', title=song.title, from_artist=from_artist), 'success')
+                messages.append(('success', _('<strong>%(title)s</strong>%(from_artist)s was successfully queued! It should be played shortly.', title=song.title, from_artist=from_artist)))
 
                 session['already_submitted_time'] = arrow.now().format()
-
-                update_db = True
             except Exception as e:
-                flash(_('Error while queuing this song: %(error)s', error=e), 'error')
+                messages.append(('error', _('Error while queuing this song: %(error)s', error=e)))
 
-        if update_db:
-            try:
-                db.session.add(song)
-                db.session.commit()
-            except Exception as e:
-                flash(_('Error while updating data related to this song: %(error)s', error=e), 'error')
+                try:
+                    Song.query.cancel_queued(song.id, app.config['VOTES_THRESHOLD'] - 1 if app.config['MODE'] == 'Vote' else 0, last_queued_at)
+                except Exception as e:
+                    messages.append(('error', _('Error while updating data related to this song: %(error)s', error=e)))
 
-    return redirect(url_for('home', **request.args.to_dict()))
+        if updated:
+            bump_votes_version()
+
+            if app.config['LIVE_UPDATES']:
+                try:
+                    event_broadcaster.publish_song(song.id)
+                except Exception as e:
+                    app.logger.error(e)
+
+    return outcome, song, messages
+
+
+def get_already_queued_message(last_queued_at):
+    return _('This song has already been queued %(last_queued_at)s. A song can be queued only one time every %(block_time)i minutes.', block_time=app.config['BLOCK_TIME'] / 60, last_queued_at=last_queued_at.humanize(locale=g.CURRENT_LOCALE))
+
+
+def get_song_payload(song, blocked=None):
+    """Compact JSON representation of a song for the API. Empty values are left out."""
+    if blocked is None:
+        blocked = song.last_queued_at is not None and (arrow.now().timestamp - song.last_queued_at.timestamp) <= app.config['BLOCK_TIME']
+
+    payload = {
+        'id': song.id,
+        'title': song.title,
+        'artist': song.artist,
+        'album': song.album,
+        'votes': song.votes,
+        'queued': blocked
+    }
+
+    return {key: value for key, value in payload.items() if value is not None}
+
+
+def get_home_etag(songs_list_cache_key, now, now_playing, submit_limited):
+    """Return the weak ETag of the home page, made of what it displays: the songs list (see its cache key), the
+    currently playing song and whether the user can submit a song. As the labels telling when songs have been queued
+    change over time, it also changes every minute."""
+    return hashlib.md5(json.dumps([
+        songs_list_cache_key,
+        now_playing,
+        submit_limited,
+        int(now.timestamp / 60)
+    ], sort_keys=True).encode()).hexdigest()
+
+
+def make_not_modified_response(etag, weak=False):
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=weak)
+
+    return response
@@ -0,0 +1,89 @@
+/**
+ * Live updates of the currently playing song and of the votes and queue state of the displayed songs, pushed by the
+ * server using Server-Sent Events.
+ */
+(function() {
+    'use strict';
+
+    var script = document.currentScript;
+
+    if (!window.EventSource || !script) {
+        return;
+    }
+
+    function searchLink(search_term, where) {
+        var link = document.createElement('a');
+
+        link.href = script.getAttribute('data-search-url') + '?q=' + encodeURIComponent(search_term) + '&w=' + where;
+        link.textContent = search_term;
+
+        return link;
+    }
+
+    var events = new EventSource(script.getAttribute('data-events-url'));
+
+    events.addEventListener('now_playing', function(e) {
+        var now_playing = JSON.parse(e.data);
+        var container = document.getElementById('now-playing');
+
+        if (!container) {
+            return;
+        }
+
+        if (!now_playing) {
+            container.hidden = true;
+
+            return;
+        }
+
+        container.querySelector('.now-playing-title').textContent = !now_playing.title && !now_playing.artist ? now_playing.filename : now_playing.title;
+
+        var details = container.querySelector('.now-playing-details');
+
+        details.textContent = '';
+
+        if (now_playing.artist) {
+            details.appendChild(searchLink(now_playing.artist, 'ar'));
+        } else {
+            details.appendChild(document.createTextNode(script.getAttribute('data-unknown-artist-label')));
+        }
+
+        if (now_playing.album) {
+            details.appendChild(document.createTextNode(' - '));
+            details.appendChild(searchLink(now_playing.album, 'al'));
+        }
+
+        container.hidden = false;
+    });
+
+    events.addEventListener('song', function(e) {
+        var song = JSON.parse(e.data);
+        var element = document.querySelector('.song[data-song-id="' + song.id + '"]');
+
+        if (!element) {
+            return;
+        }
+
+        var votes_count = element.querySelector('.votes-count');
+
+        if (votes_count) {
+            votes_count.textContent = song.votes;
+        }
+
+        if (song.queued) {
+            var button = element.querySelector('.btn');
+
+            button.className = 'btn is-disabled';
+            button.textContent = script.getAttribute('data-queued-label');
+            button.onclick = function() {
+                return false;
+            };
+
+            var votes = element.querySelector('.votes');
+
+            if (votes) {
+                votes.hidden = true;
+            }
+        }
+    });
+})();